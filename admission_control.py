@@ -0,0 +1,285 @@
+import itertools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from file_lock import FileLock
+
+# --- CONFIGURABLE SETTINGS ---
+MAX_SESSIONS_PER_FIRM = 50      # concurrent in-progress negotiations per firm
+NEW_SESSIONS_PER_SEC = 5.0      # token-bucket refill rate per firm
+NEW_SESSION_BURST = 10          # token-bucket capacity per firm
+MAX_QUEUE_DEPTH = 20            # new sessions allowed to wait before shedding
+QUEUE_TIMEOUT = 2.0             # seconds a new session may wait before shedding
+MAX_CONCURRENT_OPS = 8          # pricing/offer computations running at once
+SESSION_LEASE = 900             # seconds a shared-state session survives without a round (crashed CLI)
+OP_LEASE = 30                   # seconds a shared-state slot/queue entry survives without a refresh
+POLL_INTERVAL = 0.05            # seconds between shared-state checks while waiting
+
+class TokenBucket:
+    def __init__(self, rate, capacity, clock=time.monotonic, tokens=None, updated=None):
+        self.rate = rate
+        self.capacity = capacity
+        self.clock = clock
+        self.tokens = capacity if tokens is None else tokens
+        self.updated = clock() if updated is None else updated
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_take(self, n=1):
+        self._refill()
+        if self.tokens >= n:
+            self.tokens -= n
+            return True
+        return False
+
+    def wait_time(self, n=1):
+        """Seconds until n tokens will be available."""
+        self._refill()
+        if self.tokens >= n:
+            return 0.0
+        return (n - self.tokens) / self.rate if self.rate > 0 else float("inf")
+
+def _empty_state():
+    return {
+        "sessions": {},      # firm -> {holder: last seen}
+        "buckets": {},       # firm -> [tokens, updated]
+        "queued_new": {},    # ticket -> last seen, new sessions waiting in admit_session
+        "ops": {},           # ticket -> started, computations holding a slot
+        "round_queue": [],   # [ticket, last seen]: waiting in-flight rounds (all work if not prioritizing)
+        "new_queue": [],     # [ticket, last seen]: waiting new-session work
+        "stats": {"admitted": 0, "resumed": 0, "shed": 0},
+    }
+
+class AdmissionController:
+    """
+    Gates the negotiation entry points so sessions already in progress keep
+    low latency under overload:
+
+    - admit_session(firm): a new session needs a free per-firm session slot
+      and a token from the firm's bucket, and must wait while in-flight
+      rounds are queued. At most max_queue_depth new sessions wait (for up
+      to queue_timeout); beyond that they are shed with the contact-sales
+      fallback.
+    - resume_session(firm): sessions already in progress are always let back in.
+    - slot(in_flight): bounds concurrent pricing/offer computations; waiting
+      in-flight rounds are served before waiting new-session work.
+
+    By default the state lives in this process. With state_file it lives in
+    a JSON file guarded by an OS file lock (released by the OS if its holder
+    dies), so every CLI process on the machine shares one set of limits;
+    entries of processes that died are dropped once their lease
+    (session_lease / op_lease) runs out.
+    """
+
+    def __init__(self, max_sessions_per_firm=MAX_SESSIONS_PER_FIRM, new_sessions_per_sec=NEW_SESSIONS_PER_SEC,
+                 new_session_burst=NEW_SESSION_BURST, max_queue_depth=MAX_QUEUE_DEPTH,
+                 queue_timeout=QUEUE_TIMEOUT, max_concurrent_ops=MAX_CONCURRENT_OPS,
+                 contact_message="Please contact our sales team for assistance.",
+                 prioritize_in_flight=True, state_file=None, session_lease=SESSION_LEASE,
+                 op_lease=OP_LEASE, poll_interval=POLL_INTERVAL, clock=None):
+        self.max_sessions_per_firm = max_sessions_per_firm
+        self.new_sessions_per_sec = new_sessions_per_sec
+        self.new_session_burst = new_session_burst
+        self.max_queue_depth = max_queue_depth
+        self.queue_timeout = queue_timeout
+        self.max_concurrent_ops = max_concurrent_ops
+        self.contact_message = contact_message
+        self.prioritize_in_flight = prioritize_in_flight
+        self.state_file = state_file
+        self.session_lease = session_lease
+        self.op_lease = op_lease
+        self.poll_interval = poll_interval
+        # Shared state is compared across processes, so it needs wall-clock time
+        self.clock = clock or (time.time if state_file else time.monotonic)
+
+        self._cond = threading.Condition()
+        self._file_lock = FileLock(state_file + ".lock") if state_file else None
+        self._state = _empty_state()
+        self._held = {}   # firm -> holders of sessions this controller admitted/resumed
+        self._ids = itertools.count(1)
+
+    # --- State access ---
+    def _new_ticket(self):
+        return f"{os.getpid()}:{id(self)}:{next(self._ids)}"
+
+    def _load(self):
+        try:
+            with open(self.state_file, "r") as f:
+                state = json.load(f)
+        except (OSError, json.decoder.JSONDecodeError):
+            return _empty_state()
+        return {**_empty_state(), **state}
+
+    def _save(self):
+        tmp_file = self.state_file + ".tmp"
+        with open(tmp_file, "w") as f:
+            json.dump(self._state, f, separators=(",", ":"))
+        os.replace(tmp_file, self.state_file)
+
+    def _prune(self):
+        """Drops shared-state entries whose owners stopped refreshing them (crashed processes)."""
+        if not self.state_file:
+            return
+        now = self.clock()
+        state = self._state
+        for firm in list(state["sessions"]):
+            holders = {h: seen for h, seen in state["sessions"][firm].items() if now - seen < self.session_lease}
+            if holders:
+                state["sessions"][firm] = holders
+            else:
+                del state["sessions"][firm]
+        for name in ("queued_new", "ops"):
+            state[name] = {t: seen for t, seen in state[name].items() if now - seen < self.op_lease}
+        for name in ("round_queue", "new_queue"):
+            state[name] = [e for e in state[name] if now - e[1] < self.op_lease]
+
+    @contextmanager
+    def _locked(self):
+        """Holds the state (and its file lock when shared); self._state is current inside."""
+        with self._cond:
+            if self.state_file:
+                self._file_lock.acquire()
+                self._state = self._load()
+            try:
+                self._prune()
+                yield
+            finally:
+                if self.state_file:
+                    self._save()
+                    self._file_lock.release()
+                self._cond.notify_all()
+
+    def _wait(self, timeout=None):
+        """Inside _locked(): lets others change the state for up to timeout seconds, then reloads it."""
+        if self.state_file:
+            self._save()
+            self._file_lock.release()
+            timeout = self.poll_interval if timeout is None else min(timeout, self.poll_interval)
+        self._cond.wait(timeout)
+        if self.state_file:
+            self._file_lock.acquire()
+            self._state = self._load()
+        self._prune()
+
+    def _bucket(self, firm):
+        tokens, updated = self._state["buckets"].get(firm, (None, None))
+        return TokenBucket(self.new_sessions_per_sec, self.new_session_burst, self.clock, tokens, updated)
+
+    def _hold(self, firm):
+        holder = self._new_ticket()
+        self._state["sessions"].setdefault(firm, {})[holder] = self.clock()
+        self._held.setdefault(firm, []).append(holder)
+
+    def _renew_sessions(self):
+        now = self.clock()
+        for firm, holders in self._held.items():
+            for holder in holders:
+                self._state["sessions"].setdefault(firm, {})[holder] = now
+
+    def contact_sales_response(self):
+        """Same shape as session_log["contact_option"] in main.py."""
+        return {"show": True, "message": self.contact_message}
+
+    # --- Sessions ---
+    def admit_session(self, firm, timeout=None):
+        """
+        Tries to start a new session for firm. Returns (True, None) when
+        admitted, else (False, contact_option) with the contact-sales fallback.
+        Callers must pair an admitted session with end_session(firm).
+        """
+        timeout = self.queue_timeout if timeout is None else timeout
+        ticket = self._new_ticket()
+        with self._locked():
+            if len(self._state["queued_new"]) >= self.max_queue_depth:
+                self._state["stats"]["shed"] += 1
+                return False, self.contact_sales_response()
+            deadline = self.clock() + timeout
+            try:
+                while True:
+                    self._state["queued_new"][ticket] = self.clock()
+                    bucket = self._bucket(firm)
+                    has_room = len(self._state["sessions"].get(firm, {})) < self.max_sessions_per_firm
+                    yields = self.prioritize_in_flight and len(self._state["round_queue"]) > 0
+                    admitted = has_room and not yields and bucket.try_take()
+                    self._state["buckets"][firm] = [bucket.tokens, bucket.updated]
+                    if admitted:
+                        self._hold(firm)
+                        self._state["stats"]["admitted"] += 1
+                        return True, None
+                    remaining = deadline - self.clock()
+                    if remaining <= 0:
+                        self._state["stats"]["shed"] += 1
+                        return False, self.contact_sales_response()
+                    wait = remaining
+                    if has_room and not yields:
+                        wait = min(wait, max(bucket.wait_time(), 0.001))
+                    self._wait(wait)
+            finally:
+                self._state["queued_new"].pop(ticket, None)
+
+    def resume_session(self, firm):
+        """Lets an in-progress session back in regardless of limits."""
+        with self._locked():
+            self._hold(firm)
+            self._state["stats"]["resumed"] += 1
+
+    def end_session(self, firm):
+        with self._locked():
+            holders = self._held.get(firm)
+            if holders:
+                self._state["sessions"].get(firm, {}).pop(holders.pop(), None)
+                if not self._state["sessions"].get(firm, True):
+                    del self._state["sessions"][firm]
+
+    # --- Computation slots ---
+    @contextmanager
+    def slot(self, in_flight=True):
+        """
+        Holds one of max_concurrent_ops slots. Waiters are served FIFO, and
+        waiting in-flight rounds always go before waiting new-session work.
+        Taking a slot also renews the leases of this controller's sessions.
+        """
+        ticket = self._new_ticket()
+        with self._locked():
+            prioritized = in_flight or not self.prioritize_in_flight
+            name = "round_queue" if prioritized else "new_queue"
+            self._state[name].append([ticket, self.clock()])
+            try:
+                while True:
+                    queue = self._state[name]
+                    entry = next((e for e in queue if e[0] == ticket), None)
+                    if entry is None:
+                        # Lease lapsed while waiting (shared state only): rejoin at the back
+                        queue.append([ticket, self.clock()])
+                    else:
+                        entry[1] = self.clock()
+                    if (len(self._state["ops"]) < self.max_concurrent_ops and queue[0][0] == ticket
+                            and (prioritized or not self._state["round_queue"])):
+                        break
+                    self._wait()
+            finally:
+                self._state[name] = [e for e in self._state[name] if e[0] != ticket]
+            self._state["ops"][ticket] = self.clock()
+            self._renew_sessions()
+        try:
+            yield
+        finally:
+            with self._locked():
+                self._state["ops"].pop(ticket, None)
+
+    def snapshot(self):
+        with self._locked():
+            return {
+                "sessions": {firm: len(holders) for firm, holders in self._state["sessions"].items()},
+                "queued_new": len(self._state["queued_new"]),
+                "ops": len(self._state["ops"]),
+                "rounds_waiting": len(self._state["round_queue"]),
+                "new_work_waiting": len(self._state["new_queue"]),
+                **self._state["stats"],
+            }
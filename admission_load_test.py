@@ -0,0 +1,145 @@
+# Local overload test for admission_control.
+#
+# Runs the same workload twice -- once with admission control and once with it
+# effectively disabled -- and prints the latency of offer rounds for sessions
+# already in progress, plus how many new sessions were admitted or shed. Then
+# starts a burst of CLI-style processes (one session each) with and without a
+# shared state file, to show the limits holding across processes.
+#
+#     python admission_load_test.py [seconds]
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from multiprocessing import Pool
+
+from admission_control import AdmissionController
+
+SERVICE_TIME = 0.005        # seconds per pricing/offer computation
+MAX_CONCURRENT_OPS = 4
+IN_FLIGHT_SESSIONS = 10     # buyers already negotiating
+ROUND_THINK_TIME = 0.05     # pause between a buyer's offers
+NEW_SESSION_CLIENTS = 60    # clients hammering new-session starts (overload)
+ROUNDS_PER_NEW_SESSION = 3
+CLI_PROCESSES = 24          # CLI runs started at once, one session each
+
+def _percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(pct / 100 * len(values)))]
+
+def _work():
+    time.sleep(SERVICE_TIME * random.uniform(0.8, 1.2))
+
+def run_scenario(controller, duration):
+    stop = threading.Event()
+    round_latencies = []
+    lock = threading.Lock()
+
+    def timed_round():
+        started = time.perf_counter()
+        with controller.slot(in_flight=True):
+            _work()
+        with lock:
+            round_latencies.append(time.perf_counter() - started)
+
+    def in_flight_buyer(firm):
+        controller.resume_session(firm)
+        try:
+            while not stop.is_set():
+                timed_round()
+                time.sleep(ROUND_THINK_TIME)
+        finally:
+            controller.end_session(firm)
+
+    def new_session_client(firm):
+        while not stop.is_set():
+            admitted, _ = controller.admit_session(firm)
+            if not admitted:
+                time.sleep(0.01)
+                continue
+            try:
+                # Session start (pricing lookups) is new-session work ...
+                with controller.slot(in_flight=False):
+                    _work()
+                # ... and its later offer rounds are in-flight work.
+                for _ in range(ROUNDS_PER_NEW_SESSION):
+                    if stop.is_set():
+                        break
+                    timed_round()
+            finally:
+                controller.end_session(firm)
+
+    firms = ["Mahesh Enterprise", "Evergreen Crop"]
+    threads = [threading.Thread(target=in_flight_buyer, args=(firms[i % 2],)) for i in range(IN_FLIGHT_SESSIONS)]
+    threads += [threading.Thread(target=new_session_client, args=(firms[i % 2],)) for i in range(NEW_SESSION_CLIENTS)]
+    for t in threads:
+        t.start()
+    time.sleep(duration)
+    stop.set()
+    for t in threads:
+        t.join()
+    return round_latencies, controller.snapshot()
+
+def report(name, latencies, snapshot):
+    ms = [1000 * v for v in latencies]
+    print(f"\n{name}")
+    print(f"  rounds: {len(ms)} | p50 {_percentile(ms, 50):.1f} ms | p95 {_percentile(ms, 95):.1f} ms"
+          f" | p99 {_percentile(ms, 99):.1f} ms | max {max(ms):.1f} ms")
+    print(f"  new sessions admitted: {snapshot['admitted']} | shed: {snapshot['shed']}")
+
+def cli_process(args):
+    """One CLI run: its own controller, sharing limits only through state_file."""
+    state_file, settings = args
+    controller = AdmissionController(state_file=state_file, **settings)
+    firm = "Mahesh Enterprise"
+    admitted, _ = controller.admit_session(firm)
+    if not admitted:
+        return False, []
+    latencies = []
+    try:
+        with controller.slot(in_flight=False):
+            _work()
+        for _ in range(ROUNDS_PER_NEW_SESSION):
+            started = time.perf_counter()
+            with controller.slot(in_flight=True):
+                _work()
+            latencies.append(time.perf_counter() - started)
+            time.sleep(ROUND_THINK_TIME)
+    finally:
+        controller.end_session(firm)
+    return True, latencies
+
+def run_cli_processes(state_file, settings):
+    with Pool(CLI_PROCESSES) as pool:
+        results = pool.map(cli_process, [(state_file, settings)] * CLI_PROCESSES)
+    admitted = sum(1 for ok, _ in results if ok)
+    return admitted, CLI_PROCESSES - admitted, [v for _, lat in results for v in lat]
+
+if __name__ == "__main__":
+    duration = float(sys.argv[1]) if len(sys.argv) > 1 else 3.0
+
+    controlled = AdmissionController(
+        new_sessions_per_sec=20, new_session_burst=5, max_queue_depth=10,
+        queue_timeout=0.2, max_concurrent_ops=MAX_CONCURRENT_OPS,
+    )
+    uncontrolled = AdmissionController(
+        max_sessions_per_firm=float("inf"), new_sessions_per_sec=float("inf"),
+        new_session_burst=float("inf"), max_queue_depth=float("inf"), queue_timeout=float("inf"),
+        max_concurrent_ops=MAX_CONCURRENT_OPS, prioritize_in_flight=False,
+    )
+    report("Without admission control", *run_scenario(uncontrolled, duration))
+    report("With admission control", *run_scenario(controlled, duration))
+
+    cli_settings = dict(max_sessions_per_firm=4, new_session_burst=4, queue_timeout=0.2,
+                        max_concurrent_ops=MAX_CONCURRENT_OPS)
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, state_file in (("CLI processes, per-process state", None),
+                                 ("CLI processes, shared state file", os.path.join(tmp, "admission_state.json"))):
+            admitted, shed, latencies = run_cli_processes(state_file, cli_settings)
+            ms = [1000 * v for v in latencies]
+            print(f"\n{name}")
+            print(f"  sessions admitted: {admitted} | shed: {shed} | round p99 {_percentile(ms, 99):.1f} ms")
@@ -0,0 +1,294 @@
+import json
+import os
+import time
+from datetime import datetime, timedelta
+
+from dynamic_margin import (
+    get_plateau_state_from_log,
+    parse_event,
+    ROLLING_WINDOW_DAYS,
+    PLATEAU_MARGIN,
+    PLATEAU_DURATION,
+    ACTIVITY_THRESHOLD,
+)
+
+# --- CONFIGURABLE SETTINGS ---
+CHECKPOINT_FILE = "demand_checkpoint.json"
+CHECKPOINT_VERSION = 2
+CHECKPOINT_EVERY_EVENTS = 500
+CHECKPOINT_EVERY_SECONDS = 300
+
+# Derived demand state is a plain dict so it round-trips through JSON as is:
+# {
+#     "version": 2,
+#     "log_offset": <bytes of the event log already applied>,
+#     "products": {product_code: {"orders": [[ts, qty], ...],
+#                                 "plateau_start": ts or None,
+#                                 "plateau_sales_since": units sold since plateau_start}},
+#     "next_session_id": int,
+#     "session_log_fingerprint": [size, mtime] or None,
+# }
+
+# --- 1. Empty State ---
+def new_demand_state():
+    return {
+        "version": CHECKPOINT_VERSION,
+        "log_offset": 0,
+        "products": {},
+        "next_session_id": 1,
+        "session_log_fingerprint": None,
+        "events_since_checkpoint": 0,
+        "last_checkpoint_at": time.time(),
+    }
+
+def _product_state(state, product_code):
+    products = state["products"]
+    if product_code not in products:
+        products[product_code] = {"orders": [], "plateau_start": None, "plateau_sales_since": 0}
+    return products[product_code]
+
+# --- 2. Apply One Event (same rules as get_recent_order_count / get_plateau_state_from_log) ---
+def apply_event(state, entry, plateau_margin=PLATEAU_MARGIN):
+    product_code = entry.get("product_code")
+    parsed = parse_event(entry)
+    if product_code is None or parsed is None:
+        # Lines with fields that don't convert are skipped whole, as the log readers do
+        return
+    timestamp = entry["timestamp"]
+    ts, qty, margin = parsed
+    pstate = _product_state(state, product_code)
+
+    if entry.get("event") == "order_summary" and qty is not None:
+        pstate["orders"].append([timestamp, qty])
+
+    if margin is not None and margin >= (plateau_margin - 0.01):
+        current = pstate["plateau_start"]
+        if current is None or ts > datetime.fromisoformat(current):
+            pstate["plateau_start"] = timestamp
+            pstate["plateau_sales_since"] = 0
+
+    if entry.get("event") in ("deal_closed", "order_summary"):
+        # Only a running total since the current plateau start is kept. The log
+        # is appended in timestamp order, so sales before a new plateau entry
+        # never count towards it; with no plateau yet, nothing needs keeping.
+        # verify_checkpoint() compares against the log scan, which catches a
+        # log that breaks this ordering.
+        plateau_start = pstate["plateau_start"]
+        if plateau_start is not None and ts >= datetime.fromisoformat(plateau_start):
+            pstate["plateau_sales_since"] += qty if qty is not None else 1
+
+# --- 3. Replay the Event Log From an Offset ---
+def replay_log(state, event_log_file):
+    """
+    Applies every complete line of the event log past state["log_offset"].
+    A partially written last line is left for the next replay.
+    Returns the number of lines applied.
+    """
+    if not os.path.exists(event_log_file):
+        return 0
+    applied = 0
+    with open(event_log_file, "rb") as f:
+        f.seek(state["log_offset"])
+        offset = state["log_offset"]
+        for raw in f:
+            if not raw.endswith(b"\n"):
+                break
+            offset += len(raw)
+            try:
+                apply_event(state, json.loads(raw))
+            except Exception:
+                pass
+            applied += 1
+    state["log_offset"] = offset
+    state["events_since_checkpoint"] = state.get("events_since_checkpoint", 0) + applied
+    return applied
+
+def prune_state(state, retention_days=ROLLING_WINDOW_DAYS, now=None):
+    """Drops order entries that have fallen out of the rolling window."""
+    now = now or datetime.now()
+    cutoff = now - timedelta(days=retention_days)
+    for pstate in state["products"].values():
+        pstate["orders"] = [o for o in pstate["orders"] if datetime.fromisoformat(o[0]) >= cutoff]
+
+# --- 4. Session Id From negotiation_cli_log.json ---
+def _file_fingerprint(path):
+    if not os.path.exists(path):
+        return None
+    st = os.stat(path)
+    return [st.st_size, st.st_mtime]
+
+def refresh_session_id(state, session_log_file):
+    """Rescans the session log only when it changed since the last scan."""
+    fingerprint = _file_fingerprint(session_log_file)
+    if fingerprint is not None and fingerprint == state.get("session_log_fingerprint"):
+        return state["next_session_id"]
+    next_id = 1
+    if fingerprint is not None:
+        with open(session_log_file, "r") as f:
+            try:
+                data = json.load(f)
+            except json.decoder.JSONDecodeError:
+                data = []
+        if isinstance(data, list):
+            next_id = max((s.get("id", 0) for s in data), default=0) + 1
+    state["next_session_id"] = next_id
+    state["session_log_fingerprint"] = fingerprint
+    return state["next_session_id"]
+
+def note_session(state, session_id, session_log_file=None):
+    """Call after a session is written so restarts don't rescan the session log."""
+    state["next_session_id"] = max(state.get("next_session_id", 1), session_id + 1)
+    if session_log_file is not None:
+        state["session_log_fingerprint"] = _file_fingerprint(session_log_file)
+
+# --- 5. Queries (mirror dynamic_margin.py) ---
+def recent_order_count(state, product_code, days=ROLLING_WINDOW_DAYS, now=None):
+    pstate = state["products"].get(product_code)
+    if pstate is None:
+        return 0
+    now = now or datetime.now()
+    cutoff = now - timedelta(days=days)
+    return sum(qty for ts, qty in pstate["orders"] if datetime.fromisoformat(ts) >= cutoff)
+
+def plateau_state(state, product_code, now=None):
+    pstate = state["products"].get(product_code)
+    if pstate is None or pstate["plateau_start"] is None:
+        return {
+            "plateau_start_date": None,
+            "plateau_sales_since": 0,
+            "in_decline": False,
+            "decline_start_date": None,
+        }
+    plateau_start_date = datetime.fromisoformat(pstate["plateau_start"])
+    plateau_sales_since = pstate["plateau_sales_since"]
+    now = now or datetime.now()
+    in_decline = False
+    decline_start_date = None
+    days_on_plateau = (now - plateau_start_date).days
+    if days_on_plateau > PLATEAU_DURATION and plateau_sales_since < ACTIVITY_THRESHOLD:
+        in_decline = True
+        decline_start_date = plateau_start_date + timedelta(days=PLATEAU_DURATION)
+    return {
+        "plateau_start_date": plateau_start_date,
+        "plateau_sales_since": plateau_sales_since,
+        "in_decline": in_decline,
+        "decline_start_date": decline_start_date,
+    }
+
+# --- 6. Save / Load Checkpoints ---
+def save_checkpoint(state, checkpoint_file=CHECKPOINT_FILE):
+    prune_state(state)
+    state["events_since_checkpoint"] = 0
+    state["last_checkpoint_at"] = time.time()
+    tmp_file = checkpoint_file + ".tmp"
+    with open(tmp_file, "w") as f:
+        json.dump(state, f)
+    os.replace(tmp_file, checkpoint_file)
+
+def maybe_checkpoint(state, checkpoint_file=CHECKPOINT_FILE,
+                     every_events=CHECKPOINT_EVERY_EVENTS, every_seconds=CHECKPOINT_EVERY_SECONDS):
+    """Writes a checkpoint once enough events or time have gone by. Returns True if written."""
+    due_events = state.get("events_since_checkpoint", 0) >= every_events
+    due_time = time.time() - state.get("last_checkpoint_at", 0) >= every_seconds
+    if due_events or due_time:
+        save_checkpoint(state, checkpoint_file)
+        return True
+    return False
+
+def load_checkpoint(checkpoint_file, event_log_file):
+    """
+    Returns the checkpointed state, or None if it is missing, unreadable, from
+    another version, or no longer matches the event log (e.g. log truncated).
+    """
+    if not os.path.exists(checkpoint_file):
+        return None
+    try:
+        with open(checkpoint_file, "r") as f:
+            state = json.load(f)
+    except (OSError, json.decoder.JSONDecodeError):
+        return None
+    if not isinstance(state, dict) or state.get("version") != CHECKPOINT_VERSION:
+        return None
+    offset = state.get("log_offset", 0)
+    if offset:
+        if not os.path.exists(event_log_file) or os.path.getsize(event_log_file) < offset:
+            return None
+        with open(event_log_file, "rb") as f:
+            f.seek(offset - 1)
+            if f.read(1) != b"\n":
+                return None
+    state["events_since_checkpoint"] = 0
+    state["last_checkpoint_at"] = time.time()
+    return state
+
+def rebuild_demand_state(event_log_file, session_log_file):
+    state = new_demand_state()
+    replay_log(state, event_log_file)
+    refresh_session_id(state, session_log_file)
+    return state
+
+def load_demand_state(event_log_file, session_log_file, checkpoint_file=CHECKPOINT_FILE):
+    """
+    Startup entry point: loads the latest checkpoint and replays only the tail
+    of the event log, falling back to a full rebuild when there is no usable
+    checkpoint.
+    """
+    state = load_checkpoint(checkpoint_file, event_log_file)
+    if state is None:
+        state = rebuild_demand_state(event_log_file, session_log_file)
+        save_checkpoint(state, checkpoint_file)
+        return state
+    replay_log(state, event_log_file)
+    refresh_session_id(state, session_log_file)
+    return state
+
+# --- 7. Verification: Checkpoint + Tail vs Full Rebuild ---
+def verify_checkpoint(event_log_file, session_log_file, checkpoint_file=CHECKPOINT_FILE, now=None):
+    """
+    Compares the state restored from the checkpoint with a full rebuild,
+    and its plateau state with get_plateau_state_from_log's scan. Returns a list of human readable mismatches (empty when they agree).
+    """
+    now = now or datetime.now()
+    restored = load_checkpoint(checkpoint_file, event_log_file)
+    if restored is None:
+        return ["Checkpoint missing or not usable for this event log."]
+    replay_log(restored, event_log_file)
+    refresh_session_id(restored, session_log_file)
+    rebuilt = rebuild_demand_state(event_log_file, session_log_file)
+
+    mismatches = []
+    if restored["log_offset"] != rebuilt["log_offset"]:
+        mismatches.append(f"log_offset: checkpoint {restored['log_offset']} vs rebuild {rebuilt['log_offset']}")
+    if restored["next_session_id"] != rebuilt["next_session_id"]:
+        mismatches.append(
+            f"next_session_id: checkpoint {restored['next_session_id']} vs rebuild {rebuilt['next_session_id']}"
+        )
+    product_codes = set(restored["products"]) | set(rebuilt["products"])
+    for product_code in sorted(product_codes):
+        a = recent_order_count(restored, product_code, now=now)
+        b = recent_order_count(rebuilt, product_code, now=now)
+        if a != b:
+            mismatches.append(f"{product_code} order_count: checkpoint {a} vs rebuild {b}")
+        a = plateau_state(restored, product_code, now=now)
+        b = plateau_state(rebuilt, product_code, now=now)
+        if a != b:
+            mismatches.append(f"{product_code} plateau_state: checkpoint {a} vs rebuild {b}")
+        b = get_plateau_state_from_log(product_code, event_log_file, now=now)
+        if a != b:
+            mismatches.append(f"{product_code} plateau_state: checkpoint {a} vs log scan {b}")
+    return mismatches
+
+if __name__ == "__main__":
+    import sys
+
+    event_log_file = sys.argv[1] if len(sys.argv) > 1 else "negotiation_events.jsonl"
+    session_log_file = sys.argv[2] if len(sys.argv) > 2 else "negotiation_cli_log.json"
+    checkpoint_file = sys.argv[3] if len(sys.argv) > 3 else CHECKPOINT_FILE
+
+    problems = verify_checkpoint(event_log_file, session_log_file, checkpoint_file)
+    if problems:
+        print("❌ Checkpoint does not match a full rebuild:")
+        for p in problems:
+            print(f"  {p}")
+        sys.exit(1)
+    print("✅ Checkpoint matches a full rebuild.")
@@ -1,8 +1,9 @@
 import numpy as np
 import os
-import json
 from datetime import datetime, timedelta
 
+from event_log_index import read_product_events
+
 # --- CONFIGURABLE SETTINGS ---
 ROLLING_WINDOW_DAYS = 30
 WIGGLE_MIN_PCT = 0.05
@@ -22,7 +23,21 @@ def sigmoid_margin(order_count, max_margin=20, k=0.01, midpoint=750, threshold=5
     return max_margin / (1 + np.exp(-k * (order_count - midpoint)))
 
 # --- 2. Plateau/Decline State From Log ---
-def get_plateau_state_from_log(product_code, event_log_file, plateau_margin=PLATEAU_MARGIN):
+def parse_event(entry):
+    """
+    Returns (timestamp, quantity, margin_pct) for an event-log entry, with
+    quantity/margin_pct None when absent, or None if a field doesn't convert
+    (such a line is skipped, as replay_log in demand_checkpoint does).
+    """
+    try:
+        ts = datetime.fromisoformat(entry["timestamp"])
+        qty = int(entry["quantity"]) if "quantity" in entry else None
+        margin = entry.get("margin_pct", None)
+        return ts, qty, (float(margin) if margin is not None else None)
+    except (KeyError, TypeError, ValueError):
+        return None
+
+def get_plateau_state_from_log(product_code, event_log_file, plateau_margin=PLATEAU_MARGIN, now=None):
     plateau_start_date = None
     decline_start_date = None
     in_decline = False
@@ -37,22 +52,18 @@ def get_plateau_state_from_log(product_code, event_log_file, plateau_margin=PLAT
             "decline_start_date": None,
         }
 
-    with open(event_log_file, "r") as f:
-        for line in f:
-            try:
-                entry = json.loads(line)
-                if entry.get("product_code") == product_code:
-                    events.append(entry)
-            except Exception:
-                continue
+    # Only this product's lines are read, via the sidecar byte-offset index
+    for entry in read_product_events(event_log_file, product_code):
+        parsed = parse_event(entry)
+        if parsed is not None:
+            events.append((parsed, entry))
 
-    events = sorted(events, key=lambda x: x["timestamp"], reverse=True)
+    events = sorted(events, key=lambda x: x[0][0], reverse=True)
 
     # Find last time margin reached plateau (20%)
-    for entry in events:
-        margin = entry.get("margin_pct", None)
-        if margin is not None and float(margin) >= (plateau_margin - 0.01):
-            plateau_start_date = datetime.fromisoformat(entry["timestamp"])
+    for (entry_time, _, margin), entry in events:
+        if margin is not None and margin >= (plateau_margin - 0.01):
+            plateau_start_date = entry_time
             break
 
     if plateau_start_date is None:
@@ -65,14 +76,12 @@ def get_plateau_state_from_log(product_code, event_log_file, plateau_margin=PLAT
 
     # Count units sold since plateau
     plateau_sales_since = 0
-    for entry in events:
-        entry_time = datetime.fromisoformat(entry["timestamp"])
+    for (entry_time, qty, _), entry in events:
         if entry_time >= plateau_start_date:
             if entry.get("event") in ("deal_closed", "order_summary"):
-                qty = int(entry.get("quantity", 1))
-                plateau_sales_since += qty
+                plateau_sales_since += qty if qty is not None else 1
 
-    now = datetime.now()
+    now = now or datetime.now()
     days_on_plateau = (now - plateau_start_date).days
     if days_on_plateau > PLATEAU_DURATION and plateau_sales_since < ACTIVITY_THRESHOLD:
         in_decline = True
@@ -86,9 +95,10 @@ def get_plateau_state_from_log(product_code, event_log_file, plateau_margin=PLAT
     }
 
 # --- 3. Dynamic Margin Calculation with Plateau/Decline via Event Log ---
-def get_dynamic_margin_with_log(product_code, order_count, event_log_file):
-    state = get_plateau_state_from_log(product_code, event_log_file)
-    now = datetime.now()
+def get_dynamic_margin_with_log(product_code, order_count, event_log_file, now=None):
+    # `now` lets callers inject the clock (see margin_timeline.py cross-checks)
+    now = now or datetime.now()
+    state = get_plateau_state_from_log(product_code, event_log_file, now=now)
 
     if state["plateau_start_date"] is None:
         # Never hit plateau
@@ -164,17 +174,23 @@ def get_min_bulk_margin(cp, percent=0.06, min_rs=20, max_rs=200):
 
 # --- 9. Hybrid Margin Calculation (with Plateau/Decline Logic via Event Log) ---
 def get_hybrid_min_negotiation(
-    cp, lp, order_count, bulk_price, qty, bulk_threshold, product_code, event_log_file, buffer=1.0, min_margin_buffer=2
+    cp, lp, order_count, bulk_price, qty, bulk_threshold, product_code, event_log_file, buffer=1.0, min_margin_buffer=2,
+    margin_timelines=None, now=None
 ):
     """
     Returns the minimum negotiation price and formula used (hybrid logic) using event log for margin logic.
+    If margin_timelines (margin_timeline.MarginTimelines) is given, the plateau/decline margin is
+    looked up from its precomputed schedule instead of being rederived from the log.
     """
     wiggle_room = get_dynamic_wiggle_room(lp, cp)
     classification = classify_product(cp, lp, wiggle_room)
     cap = calculate_margin_cap(cp, bulk_price, buffer)
 
     # Use event log for dynamic margin plateau/decline logic
-    sig_margin = get_dynamic_margin_with_log(product_code, order_count, event_log_file)
+    if margin_timelines is not None:
+        sig_margin = margin_timelines.margin_at(product_code, order_count, now)
+    else:
+        sig_margin = get_dynamic_margin_with_log(product_code, order_count, event_log_file, now=now)
     dynamic_margin = min(sig_margin, cap)
     classic_min = classic_min_negotiation(cp, lp)
     sigmoid_min = classic_min + dynamic_margin
@@ -196,23 +212,18 @@ def get_hybrid_min_negotiation(
     return final_min, classification
 
 # --- 10. Get Rolling Order Count for Product ---
-def get_recent_order_count(product_code, days, log_file):
+def get_recent_order_count(product_code, days, log_file, now=None):
     if not os.path.exists(log_file):
         return 0
-    now = datetime.now()
+    now = now or datetime.now()
     cutoff = now - timedelta(days=days)
     total_qty = 0
-    with open(log_file, 'r') as f:
-        for line in f:
-            record = json.loads(line)
-            if (
-                record.get('event') == 'order_summary'
-                and record.get('product_code') == product_code
-                and 'quantity' in record
-            ):
-                order_time = datetime.fromisoformat(record['timestamp'])
-                if order_time >= cutoff:
-                    total_qty += int(record['quantity'])
+    # Seek straight to this product's lines from the cutoff day on; bad lines are skipped
+    for record in read_product_events(log_file, product_code, since_day=cutoff.date().isoformat()):
+        if record.get('event') == 'order_summary' and 'quantity' in record:
+            parsed = parse_event(record)
+            if parsed is not None and parsed[0] >= cutoff:
+                total_qty += parsed[1]
     return total_qty
 
 # --- Example Usage for Testing ---
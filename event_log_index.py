@@ -0,0 +1,191 @@
+import json
+import mmap
+import os
+import struct
+import zlib
+
+import numpy as np
+
+# Sidecar index for the JSONL event log: one fixed-width little-endian record
+# per log line, in log order,
+#     offset (u64) | length (u32) | crc32(product_code) (u32) | day as YYYYMMDD (u32)
+# with product/day 0 for lines that don't parse. Records are loaded with
+# np.fromfile and filtered vectorized, so a lookup never parses the index
+# entry by entry. The end of the last record is how far the log is indexed.
+
+INDEX_SUFFIX = ".idx"
+INDEX_DTYPE = np.dtype([("offset", "<u8"), ("length", "<u4"), ("product", "<u4"), ("day", "<u4")])
+_RECORD = struct.Struct("<QIII")
+
+class IndexMismatch(Exception):
+    """The index points at bytes that don't hold the line it expects."""
+
+def index_path(log_file):
+    return log_file + INDEX_SUFFIX
+
+def _product_key(product_code):
+    return zlib.crc32(str(product_code).encode("utf-8")) if product_code else 0
+
+def _day_key(day):
+    """'YYYY-MM-DD' -> YYYYMMDD as an int, 0 if it isn't a date."""
+    digits = str(day)[:10].replace("-", "")
+    return int(digits) if len(digits) == 8 and digits.isdigit() else 0
+
+def _parse_line(raw):
+    """Returns (product_code, entry) for a log line, or ("", None) if it doesn't parse."""
+    try:
+        entry = json.loads(raw)
+        return (entry.get("product_code") or ""), entry
+    except Exception:
+        return "", None
+
+def _index_record(offset, raw):
+    product_code, entry = _parse_line(raw)
+    day = _day_key(entry.get("timestamp", "")) if entry is not None else 0
+    return _RECORD.pack(offset, len(raw), _product_key(product_code), day)
+
+# --- 1. Maintain on Append ---
+def append_index_entry(log_file, offset, raw):
+    """Called by log_event after writing `raw` (the encoded line) at `offset`."""
+    with open(index_path(log_file), "ab") as f:
+        f.write(_index_record(offset, raw))
+
+# --- 2. Rebuild From Scratch ---
+def rebuild_index(log_file):
+    tmp_file = index_path(log_file) + ".tmp"
+    offset = 0
+    with open(tmp_file, "wb") as out:
+        if os.path.exists(log_file):
+            with open(log_file, "rb") as f:
+                for raw in f:
+                    if not raw.endswith(b"\n"):
+                        break
+                    out.write(_index_record(offset, raw))
+                    offset += len(raw)
+    os.replace(tmp_file, index_path(log_file))
+
+# --- 3. Load + Validate ---
+def _read_records(log_file):
+    """The index as a structured array, or None if it is missing or not a valid index."""
+    idx_file = index_path(log_file)
+    if not os.path.exists(idx_file):
+        return None
+    size = os.path.getsize(idx_file)
+    if size % INDEX_DTYPE.itemsize:
+        return None
+    records = np.fromfile(idx_file, dtype=INDEX_DTYPE)
+    if len(records):
+        offsets = records["offset"]
+        ends = offsets + records["length"]
+        if offsets[0] != 0 or not np.array_equal(offsets[1:], ends[:-1]):
+            return None
+    return records
+
+def _load_index(log_file):
+    """
+    Returns the index records for log_file. Rebuilds the index when it is
+    missing, malformed, points past the end of the log (truncation) or its
+    last record no longer matches the log (log replaced). Lines appended to
+    the log without going through log_event are indexed on the way.
+    """
+    log_size = os.path.getsize(log_file)
+    records = _read_records(log_file)
+    if records is not None and len(records):
+        last = records[-1]
+        offset, length = int(last["offset"]), int(last["length"])
+        if offset + length > log_size:
+            records = None
+        else:
+            with open(log_file, "rb") as f:
+                f.seek(offset)
+                raw = f.read(length)
+            if len(raw) != length or not raw.endswith(b"\n") \
+                    or _product_key(_parse_line(raw)[0]) != int(last["product"]):
+                records = None
+    if records is None:
+        rebuild_index(log_file)
+        records = _read_records(log_file)
+
+    covered_end = int(records["offset"][-1] + records["length"][-1]) if len(records) else 0
+    if log_size > covered_end:
+        # Catch up on lines written by something other than log_event.
+        offset = covered_end
+        with open(log_file, "rb") as f:
+            f.seek(offset)
+            for raw in f:
+                if not raw.endswith(b"\n"):
+                    break
+                append_index_entry(log_file, offset, raw)
+                offset += len(raw)
+        if offset > covered_end:
+            records = _read_records(log_file)
+    return records
+
+# --- 4. Readers ---
+def _scan_product_events(log_file, product_code, since_day=None):
+    """Plain full scan, skipping lines that don't parse."""
+    with open(log_file, "rb") as f:
+        for raw in f:
+            try:
+                entry = json.loads(raw)
+            except Exception:
+                continue
+            if not isinstance(entry, dict) or entry.get("product_code") != product_code:
+                continue
+            if since_day and str(entry.get("timestamp", ""))[:10] < since_day:
+                continue
+            yield entry
+
+def _indexed_product_events(log_file, product_code, since_day=None):
+    records = _load_index(log_file)
+    if records is None:
+        raise IndexMismatch(f"{log_file}: index unreadable after rebuild")
+    mask = records["product"] == _product_key(product_code)
+    if since_day:
+        mask &= records["day"] >= _day_key(since_day)
+    hits = records[mask]
+    if not len(hits):
+        return []
+    entries = []
+    with open(log_file, "rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            for offset, length in zip(hits["offset"].tolist(), hits["length"].tolist()):
+                raw = mm[offset:offset + length]
+                if len(raw) != length or not raw.endswith(b"\n"):
+                    raise IndexMismatch(f"{log_file} @ {offset}")
+                code, entry = _parse_line(raw)
+                if entry is None or _product_key(code) != _product_key(product_code):
+                    raise IndexMismatch(f"{log_file} @ {offset}")
+                if code == product_code:
+                    # A differing code with the same crc32 is a collision, not corruption
+                    entries.append(entry)
+    return entries
+
+def read_product_events(log_file, product_code, since_day=None):
+    """
+    Returns the event-log entries for product_code (optionally only those
+    stamped on or after since_day, 'YYYY-MM-DD'), reading just their lines
+    through the sidecar index. If the index doesn't match the log it is
+    rebuilt once; if that fails too, falls back to a full scan.
+    """
+    if not os.path.exists(log_file):
+        return []
+    try:
+        return _indexed_product_events(log_file, product_code, since_day)
+    except (IndexMismatch, OSError, ValueError):
+        pass
+    try:
+        rebuild_index(log_file)
+        return _indexed_product_events(log_file, product_code, since_day)
+    except (IndexMismatch, OSError, ValueError):
+        return list(_scan_product_events(log_file, product_code, since_day))
+
+if __name__ == "__main__":
+    import sys
+
+    log_file = sys.argv[1] if len(sys.argv) > 1 else "negotiation_events.jsonl"
+    rebuild_index(log_file)
+    records = _load_index(log_file)
+    covered = int(records["offset"][-1] + records["length"][-1]) if len(records) else 0
+    print(f"✅ Indexed {covered} bytes ({len(records)} lines) of {log_file}"
+          f" across {len(np.unique(records['product']))} products.")
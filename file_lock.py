@@ -0,0 +1,69 @@
+import os
+import time
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+class FileLock:
+    """
+    Exclusive lock on a file, via fcntl.flock on POSIX and msvcrt.locking on
+    Windows. The OS drops the lock when the holding process dies, so a crash
+    never leaves a stale lock behind. The lock file itself is left in place.
+    """
+
+    def __init__(self, path, poll_interval=0.005):
+        self.path = path
+        self.poll_interval = poll_interval
+        self._fd = None
+
+    def _try_lock(self, fd, blocking):
+        if fcntl is not None:
+            fcntl.flock(fd, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        else:
+            os.lseek(fd, 0, os.SEEK_SET)
+            msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+
+    def acquire(self, blocking=True):
+        """Takes the lock. With blocking=False returns False at once if another holder has it."""
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT)
+        while True:
+            try:
+                self._try_lock(fd, blocking)
+                self._fd = fd
+                return True
+            except OSError:
+                if not blocking:
+                    os.close(fd)
+                    return False
+                # msvcrt has no blocking lock without a retry limit
+                time.sleep(self.poll_interval)
+            except BaseException:
+                os.close(fd)
+                raise
+
+    def release(self):
+        fd, self._fd = self._fd, None
+        if fd is None:
+            return
+        try:
+            if fcntl is not None:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+            else:
+                os.lseek(fd, 0, os.SEEK_SET)
+                msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+        finally:
+            os.close(fd)
+
+    @property
+    def held(self):
+        return self._fd is not None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
@@ -5,18 +5,35 @@ from datetime import datetime
 
 from negotiation_formulas import main_negotiation_min, fallback_negotiation_min
 from negotiation_helpers import classify_product, fallback_counter_offer
-from dynamic_margin import get_hybrid_min_negotiation, get_recent_order_count, get_dynamic_wiggle_room
+from dynamic_margin import get_hybrid_min_negotiation, get_dynamic_wiggle_room
 from negotiation_event_logger import log_event
+from event_log_index import read_product_events
+from demand_checkpoint import (
+    load_demand_state, replay_log, recent_order_count, refresh_session_id, note_session, maybe_checkpoint
+)
+from session_manager import SessionManager, SessionClaimed
+from file_lock import FileLock
+from admission_control import AdmissionController
+from margin_timeline import MarginTimelines
+from negotiation_analytics import (
+    build_product_index, load_rollups, rebuild_rollups, catch_up_sessions, ingest_events,
+    save_rollups
+)
 
 # ---------- CONFIGURATION ----------
 PRODUCTS_FILE = r'D:\Bot\products_firms.json'
 LOG_FILE = r'D:\New Bot\negotiation_cli_log.json'
 EVENT_LOG_FILE = "negotiation_events.jsonl"
+CHECKPOINT_FILE = "demand_checkpoint.json"
+ANALYTICS_FILE = "negotiation_analytics.json"
+SESSION_CHECKPOINT_DIR = "session_checkpoints"
+ADMISSION_STATE_FILE = "admission_state.json"
 CONTACT_EMAIL = "sales@yourcompany.com"
 CONTACT_PHONE = "+91-XXXXXXXXXX"
 BULK_SUGGEST_TOLERANCE = 20
 BULK_THRESHOLD_TOLERANCE = 5
 ROLLING_WINDOW_DAYS = 30
+SESSION_CLAIMED_MESSAGE = "\n⚠️ This negotiation sat idle and was resumed in another window. Please continue it there."
 
 def load_all_sessions():
     if os.path.exists(LOG_FILE):
@@ -37,11 +54,60 @@ def load_all_sessions():
     else:
         return []
 
+def save_all_sessions():
+    # Write-then-rename, so a crash mid-write can't leave the session log empty
+    tmp_file = LOG_FILE + ".tmp"
+    with open(tmp_file, "w") as f:
+        json.dump(all_sessions, f, indent=4)
+    os.replace(tmp_file, LOG_FILE)
+
+def record_finished_session(session_log):
+    """
+    Appends a finished session to the session log unless it is already there
+    (written before a crash it was resumed from). The log is re-read under its
+    lock first, so sessions other CLI processes finished meanwhile are kept.
+    """
+    with FileLock(LOG_FILE + ".lock"):
+        all_sessions[:] = load_all_sessions()
+        if any(s.get("id") == session_log["id"] for s in all_sessions):
+            return False
+        all_sessions.append(session_log)
+        save_all_sessions()
+        return True
+
 all_sessions = load_all_sessions()
+demand_state = load_demand_state(EVENT_LOG_FILE, LOG_FILE, CHECKPOINT_FILE)
+session_manager = SessionManager(SESSION_CHECKPOINT_DIR)
+margin_timelines = MarginTimelines(demand_state)
+# Limits are shared by every CLI process through ADMISSION_STATE_FILE
+admission = AdmissionController(
+    state_file=ADMISSION_STATE_FILE,
+    contact_message=f"Contact our sales professional at {CONTACT_EMAIL} or {CONTACT_PHONE} for assistance."
+)
 
 with open(PRODUCTS_FILE, 'r') as f:
     firms = json.load(f)
 
+product_index = build_product_index(firms)
+analytics = load_rollups(ANALYTICS_FILE)
+if analytics is None:
+    analytics = rebuild_rollups(LOG_FILE, EVENT_LOG_FILE, product_index, workers=1)
+    save_rollups(analytics, ANALYTICS_FILE)
+elif catch_up_sessions(analytics, all_sessions, product_index) + ingest_events(analytics, EVENT_LOG_FILE, product_index):
+    # Sessions/events written before a crash kept them out of the saved rollups
+    save_rollups(analytics, ANALYTICS_FILE)
+
+def update_analytics():
+    # Records everything appended to the session log since the last call
+    catch_up_sessions(analytics, all_sessions, product_index)
+    ingest_events(analytics, EVENT_LOG_FILE, product_index)
+    save_rollups(analytics, ANALYTICS_FILE)
+
+def session_events_logged(product_code, session_id):
+    """Event types already logged for this session, e.g. before a crash it is being resumed from."""
+    return {e.get("event") for e in read_product_events(EVENT_LOG_FILE, product_code)
+            if e.get("order_id") == session_id}
+
 def list_firms():
     print("\nAvailable Firms:")
     for idx, firm in enumerate(firms, 1):
@@ -144,92 +210,150 @@ def show_variant_details(prod):
     else:
         print("Variant not found."); return None, None
 
-def negotiation_logic(product_name, product_code, firm, category, variant_name, variant_info, qty):
+def negotiation_logic(product_name, product_code, firm, category, variant_name, variant_info, qty, resume_state=None):
     lp = variant_info["list_price"]
     cp = variant_info["cost_price"]
     bp = variant_info["bulk_price"]
     bt = variant_info["bulk_threshold"]
-    user_id = random.randint(1000, 9999)
-    now = datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
-    session_id = max((s.get("id", 0) for s in all_sessions), default=0) + 1
-
-    order_count = get_recent_order_count(product_code, ROLLING_WINDOW_DAYS, EVENT_LOG_FILE)
-    wiggle_room = get_dynamic_wiggle_room(lp, cp)
-
-    min_negotiation, classification = get_hybrid_min_negotiation(
-        cp, lp, order_count, bp, qty, bt, product_code, EVENT_LOG_FILE
-    )
-
-    session_log = {
-        "id": session_id,
-        "quantity": qty,
-        "created_at": now,
-        "updated_at": now,
-        "product_code": product_code,
-        "product_name": product_name,
-        "variant": variant_name,
-        "price": lp,
-        "cost_price": cp,
-        "firm": firm,
-        "category": category,
-        "negotiation_min": min_negotiation,
-        "classification": classification,
-        "history": [],
-        "final_status": None,
-        "final_price": None,
-        "user_id": user_id,
-        "contact_option": {"show": False, "message": ""}
-    }
-
-    print(f"\n🛒 Negotiation for {product_name} ({variant_name})")
-    print(f"Firm: {firm}")
-    print(f"Category: {category}")
-    print(f"List Price: ₹{lp}")
-    print(f"Bulk Price: ₹{bp}")
-    print(f"Bulk Threshold: {bt}")
-    print(f"Margin classification: {classification}")
-
-    # --- Bulk threshold nudge before negotiation loop ---
-    if qty < bt and (bt - qty) <= BULK_THRESHOLD_TOLERANCE:
-        print(f"\n💡 You’re only {bt - qty} unit(s) away from unlocking the bulk price of ₹{bp} per unit!")
-        upgrade = input(f"Would you like to increase your quantity to {bt} and get the better rate? (yes/no): ").strip().lower()
-        if upgrade == "yes":
-            qty = bt
-            print(f"\n👍 Quantity upgraded to {bt} units. Let's negotiate at the bulk rate!")
+    if resume_state is None:
+        user_id = random.randint(1000, 9999)
+        now = datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
+        # Session setup is new-session work: it yields to rounds of sessions in progress
+        with admission.slot(in_flight=False):
+            replay_log(demand_state, EVENT_LOG_FILE)
+            # Reserved before any prompt, so no other CLI process can start the same id
+            while True:
+                session_id = session_manager.reserve(demand_state["next_session_id"])
+                # ...nor has finished it since this process last read the session log
+                if refresh_session_id(demand_state, LOG_FILE) <= session_id:
+                    break
+                session_manager.finish(session_id)
+            note_session(demand_state, session_id)
+
+            order_count = recent_order_count(demand_state, product_code, ROLLING_WINDOW_DAYS)
+            wiggle_room = get_dynamic_wiggle_room(lp, cp)
+
             min_negotiation, classification = get_hybrid_min_negotiation(
-                cp, lp, order_count, bp, qty, bt, product_code, EVENT_LOG_FILE
+                cp, lp, order_count, bp, qty, bt, product_code, EVENT_LOG_FILE, margin_timelines=margin_timelines
             )
-        else:
-            print(f"\nOkay, proceeding with your original quantity of {qty} units.")
-
-    if classification == "no_negotiation" or min_negotiation is None:
-        print(f"\n❌ Negotiation is not possible for this product due to tight pricing (margin too thin for any wiggle room).")
-        session_log["final_status"] = "no deal"
-        session_log["final_price"] = None
-        session_log["contact_option"] = {
-            "show": True,
-            "message": f"Contact our sales professional at {CONTACT_EMAIL} or {CONTACT_PHONE} for assistance."
-        }
-        all_sessions.append(session_log)
-        with open(LOG_FILE, "w") as f:
-            json.dump(all_sessions, f, indent=4)
-        log_event("negotiation_blocked", {
+
+        session_log = {
+            "id": session_id,
+            "quantity": qty,
+            "created_at": now,
+            "updated_at": now,
             "product_code": product_code,
-            "qty": qty,
-            "lp": lp,
-            "cp": cp,
+            "product_name": product_name,
+            "variant": variant_name,
+            "price": lp,
+            "cost_price": cp,
+            "firm": firm,
+            "category": category,
+            "negotiation_min": min_negotiation,
             "classification": classification,
-            "order_count": order_count,
-            "reason": "Margin below wiggle room"
-        })
-        return
+            "history": [],
+            "final_status": None,
+            "final_price": None,
+            "user_id": user_id,
+            "bulk_upgrade": False,
+            "contact_option": {"show": False, "message": ""}
+        }
 
-    accepted = False
-    history = []
-    stage, last_ctr = 0, None
+        print(f"\n🛒 Negotiation for {product_name} ({variant_name})")
+        print(f"Firm: {firm}")
+        print(f"Category: {category}")
+        print(f"List Price: ₹{lp}")
+        print(f"Bulk Price: ₹{bp}")
+        print(f"Bulk Threshold: {bt}")
+        print(f"Margin classification: {classification}")
+
+        # --- Bulk threshold nudge before negotiation loop ---
+        if qty < bt and (bt - qty) <= BULK_THRESHOLD_TOLERANCE:
+            print(f"\n💡 You’re only {bt - qty} unit(s) away from unlocking the bulk price of ₹{bp} per unit!")
+            upgrade = input(f"Would you like to increase your quantity to {bt} and get the better rate? (yes/no): ").strip().lower()
+            if upgrade == "yes":
+                qty = bt
+                session_log["bulk_upgrade"] = True
+                print(f"\n👍 Quantity upgraded to {bt} units. Let's negotiate at the bulk rate!")
+                with admission.slot(in_flight=False):
+                    min_negotiation, classification = get_hybrid_min_negotiation(
+                        cp, lp, order_count, bp, qty, bt, product_code, EVENT_LOG_FILE,
+                        margin_timelines=margin_timelines
+                    )
+            else:
+                print(f"\nOkay, proceeding with your original quantity of {qty} units.")
+
+        if classification == "no_negotiation" or min_negotiation is None:
+            print(f"\n❌ Negotiation is not possible for this product due to tight pricing (margin too thin for any wiggle room).")
+            session_log["final_status"] = "no deal"
+            session_log["final_price"] = None
+            session_log["contact_option"] = {
+                "show": True,
+                "message": f"Contact our sales professional at {CONTACT_EMAIL} or {CONTACT_PHONE} for assistance."
+            }
+            record_finished_session(session_log)
+            log_event("negotiation_blocked", {
+                "product_code": product_code,
+                "qty": qty,
+                "lp": lp,
+                "cp": cp,
+                "classification": classification,
+                "order_count": order_count,
+                "reason": "Margin below wiggle room"
+            })
+            note_session(demand_state, session_id, LOG_FILE)
+            replay_log(demand_state, EVENT_LOG_FILE)
+            maybe_checkpoint(demand_state, CHECKPOINT_FILE)
+            update_analytics()
+            session_manager.finish(session_id)
+            return
+
+        accepted = False
+        history = []
+        stage, last_ctr = 0, None
+        round_num, last_bot_offer = 1, None
+    else:
+        # Picking up a session that was evicted or interrupted mid-negotiation
+        session_id = resume_state["session_id"]
+        qty = resume_state["qty"]
+        order_count = resume_state["order_count"]
+        min_negotiation = resume_state["min_negotiation"]
+        classification = resume_state["classification"]
+        session_log = resume_state["session_log"]
+        accepted = resume_state.get("accepted", False)
+        history = resume_state["history"]
+        stage, last_ctr = resume_state["stage"], resume_state["last_ctr"]
+        round_num, last_bot_offer = resume_state["round_num"], resume_state["last_bot_offer"]
+        print(f"\n🔄 Resuming negotiation #{session_id} for {product_name} ({variant_name}), {qty} unit(s).")
+
+    def checkpoint_session():
+        # Runs once per round, so this is where a session's rounds take their slot
+        with admission.slot(in_flight=True):
+            session_manager.put(session_id, {
+                "session_id": session_id,
+                "product_name": product_name,
+                "product_code": product_code,
+                "firm": firm,
+                "category": category,
+                "variant_name": variant_name,
+                "variant_info": variant_info,
+                "qty": qty,
+                "order_count": order_count,
+                "min_negotiation": min_negotiation,
+                "classification": classification,
+                "session_log": session_log,
+                "history": history,
+                "stage": stage,
+                "last_ctr": last_ctr,
+                "round_num": round_num,
+                "last_bot_offer": last_bot_offer,
+                "accepted": accepted,
+            })
+
+    checkpoint_session()
 
     if classification == "main":
-        while not accepted and stage < 3:
+        while not accepted and stage < 3 and session_log["final_status"] is None:
             try:
                 offer = int(input("\n💬 Your offer per unit (₹): "))
             except Exception:
@@ -242,10 +366,14 @@ def negotiation_logic(product_name, product_code, firm, category, variant_name,
                 upgrade = input(f"Would you like to proceed with a bulk order of {bt} units? (yes/no): ").strip().lower()
                 if upgrade == "yes":
                     qty = bt
+                    session_log["bulk_upgrade"] = True
                     print(f"\n👍 Quantity upgraded to {bt} units. Let's negotiate at the bulk rate!")
-                    min_negotiation, classification = get_hybrid_min_negotiation(
-                        cp, lp, order_count, bp, qty, bt, product_code, EVENT_LOG_FILE
-                    )
+                    with admission.slot(in_flight=True):
+                        min_negotiation, classification = get_hybrid_min_negotiation(
+                            cp, lp, order_count, bp, qty, bt, product_code, EVENT_LOG_FILE,
+                            margin_timelines=margin_timelines
+                        )
+                    checkpoint_session()
                     continue
                 else:
                     print(f"\nOkay, proceeding with your original quantity of {qty} units.")
@@ -266,6 +394,7 @@ def negotiation_logic(product_name, product_code, firm, category, variant_name,
                     "show": True,
                     "message": f"Contact our sales professional at {CONTACT_EMAIL} or {CONTACT_PHONE} for assistance."
                 }
+                checkpoint_session()
                 break
 
             if last_ctr is not None and offer >= last_ctr and offer >= min_negotiation:
@@ -307,17 +436,19 @@ def negotiation_logic(product_name, product_code, firm, category, variant_name,
                 "bot_counter_offer": last_ctr if last_ctr is not None else None,
                 "timestamp": datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
             })
+            if accepted:
+                session_log["final_status"] = "deal"
+                session_log["final_price"] = offer
             print(f"\n🤖 {resp}")
+            checkpoint_session()
 
     else:
         # Fallback logic for non-main
         fallback_min = fallback_negotiation_min(cp, lp)
         session_log["negotiation_min"] = fallback_min
-        accepted = False
-        round_num = 1
-        last_bot_offer = None
 
-        print(f"\n🤖 This product is special—let's negotiate!")
+        if not accepted and round_num <= 2:
+            print(f"\n🤖 This product is special—let's negotiate!")
         while round_num <= 2 and not accepted:
             try:
                 offer = int(input(f"\n💬 Your offer per unit (₹): "))
@@ -337,22 +468,8 @@ def negotiation_logic(product_name, product_code, firm, category, variant_name,
                 print(f"\n🤖 {resp}")
                 session_log["final_status"] = "deal"
                 session_log["final_price"] = offer
-                log_event("deal_closed", {
-                    "product_code": product_code,
-                    "qty": qty,
-                    "lp": lp,
-                    "cp": cp,
-                    "negotiation_min": fallback_min,
-                    "classification": "fallback",
-                    "order_count": order_count
-                })
-                log_event("order_summary", {
-                    "order_id": session_id,
-                    "product_code": product_code,
-                    "quantity": qty,
-                    "timestamp": datetime.now().isoformat()
-                })
                 accepted = True
+                checkpoint_session()
                 break
 
             bot_counter = fallback_counter_offer(offer, fallback_min, lp, round_num)
@@ -374,8 +491,29 @@ def negotiation_logic(product_name, product_code, firm, category, variant_name,
             })
             print(f"\n🤖 {resp}")
             round_num += 1
+            checkpoint_session()
 
-        if not accepted:
+        if accepted:
+            logged = session_events_logged(product_code, session_id) if resume_state is not None else set()
+            if "deal_closed" not in logged:
+                log_event("deal_closed", {
+                    "order_id": session_id,
+                    "product_code": product_code,
+                    "qty": qty,
+                    "lp": lp,
+                    "cp": cp,
+                    "negotiation_min": fallback_min,
+                    "classification": "fallback",
+                    "order_count": order_count
+                })
+            if "order_summary" not in logged:
+                log_event("order_summary", {
+                    "order_id": session_id,
+                    "product_code": product_code,
+                    "quantity": qty,
+                    "timestamp": datetime.now().isoformat()
+                })
+        elif not accepted:
             print("\n🤝 We couldn't finalize the deal. Would you like to contact a professional for assistance?")
             print(f"Contact: {CONTACT_EMAIL} or call {CONTACT_PHONE}")
             session_log["final_status"] = "no deal"
@@ -385,13 +523,50 @@ def negotiation_logic(product_name, product_code, firm, category, variant_name,
                 "message": f"Contact our sales professional at {CONTACT_EMAIL} or {CONTACT_PHONE} for assistance."
             }
 
+    # A resumed session may have been written to the session log before the crash
     session_log["updated_at"] = datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
-    all_sessions.append(session_log)
-    with open(LOG_FILE, "w") as f:
-        json.dump(all_sessions, f, indent=4)
+    record_finished_session(session_log)
+    note_session(demand_state, session_id, LOG_FILE)
+    replay_log(demand_state, EVENT_LOG_FILE)
+    maybe_checkpoint(demand_state, CHECKPOINT_FILE)
+    update_analytics()
+    session_manager.finish(session_id)
     print("\n✅ Negotiation complete. Log → negotiation_cli_log.json")
 
+def resume_flow():
+    pending = session_manager.pending_sessions()
+    if not pending:
+        return False
+    print(f"\nUnfinished negotiations: {', '.join(str(sid) for sid in pending)}")
+    choice = input("Enter a session id to resume, or press Enter to start a new one: ").strip()
+    if not choice.isdigit():
+        return False
+    # Claimed before resuming, so two processes can't both continue it
+    state = session_manager.claim(int(choice))
+    if state is None:
+        print("Session not found, or still in progress in another window."); return False
+    # In-progress sessions are never turned away by admission control
+    admission.resume_session(state["firm"])
+    try:
+        negotiation_logic(
+            product_name=state["product_name"],
+            product_code=state["product_code"],
+            firm=state["firm"],
+            category=state["category"],
+            variant_name=state["variant_name"],
+            variant_info=state["variant_info"],
+            qty=state["qty"],
+            resume_state=state
+        )
+    except SessionClaimed:
+        print(SESSION_CLAIMED_MESSAGE)
+    finally:
+        admission.end_session(state["firm"])
+    return True
+
 def main_flow():
+    if resume_flow():
+        return
     firm_name = select_firm()
     if not firm_name:
         return
@@ -412,15 +587,25 @@ def main_flow():
     except Exception:
         print("Invalid quantity.")
         return
-    negotiation_logic(
-        product_name=prod["product_name"],
-        product_code=prod["product_code"],
-        firm=firm_name,
-        category=cat_name,
-        variant_name=vname,
-        variant_info=vinfo,
-        qty=qty
-    )
+    admitted, contact_option = admission.admit_session(firm_name)
+    if not admitted:
+        print("\n⏳ We're handling a lot of negotiations right now and can't start a new one.")
+        print(contact_option["message"])
+        return
+    try:
+        negotiation_logic(
+            product_name=prod["product_name"],
+            product_code=prod["product_code"],
+            firm=firm_name,
+            category=cat_name,
+            variant_name=vname,
+            variant_info=vinfo,
+            qty=qty
+        )
+    except SessionClaimed:
+        print(SESSION_CLAIMED_MESSAGE)
+    finally:
+        admission.end_session(firm_name)
 
 if __name__ == "__main__":
     main_flow()
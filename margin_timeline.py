@@ -0,0 +1,142 @@
+import json
+import os
+from bisect import bisect_right
+from datetime import datetime, timedelta
+
+from demand_checkpoint import new_demand_state, replay_log
+from dynamic_margin import (
+    sigmoid_margin,
+    get_dynamic_margin_with_log,
+    PLATEAU_MARGIN,
+    PLATEAU_DURATION,
+    DECLINE_RATE,
+    DECLINE_STEP_DAYS,
+)
+
+# --- 1. Piecewise-Constant Margin Schedule ---
+def build_margin_timeline(plateau_start_date, order_count):
+    """
+    Precomputes what get_dynamic_margin_with_log returns over time for one
+    product at a given order_count: values[i] holds from times[i-1] (or
+    forever before times[0]) until times[i]; the last value holds forever.
+
+    Before plateau_start + PLATEAU_DURATION (and during the first decline
+    step) the margin is PLATEAU_MARGIN; after that it drops DECLINE_RATE
+    every DECLINE_STEP_DAYS until it reaches the sigmoid floor.
+    """
+    floor = sigmoid_margin(order_count)
+    timeline = {
+        "plateau_start_date": plateau_start_date,
+        "order_count": order_count,
+        "times": [],
+        "values": [],
+    }
+    if plateau_start_date is None:
+        timeline["values"].append(floor)
+        return timeline
+
+    decline_start = plateau_start_date + timedelta(days=PLATEAU_DURATION)
+    timeline["values"].append(max(PLATEAU_MARGIN, floor))
+    step = 1
+    while True:
+        declined_margin = PLATEAU_MARGIN - DECLINE_RATE * step
+        timeline["times"].append(decline_start + timedelta(days=DECLINE_STEP_DAYS * step))
+        timeline["values"].append(max(declined_margin, floor))
+        if declined_margin <= floor:
+            break
+        step += 1
+    return timeline
+
+def margin_from_timeline(timeline, now):
+    return timeline["values"][bisect_right(timeline["times"], now)]
+
+# --- 2. Per-Product Timelines Over the Demand State ---
+class MarginTimelines:
+    """
+    Keeps one precomputed margin timeline per product so quotes are a binary
+    search instead of a log rescan. Step boundaries are part of the timeline,
+    so nothing has to be refreshed when one passes.
+
+    Plateau starts are read from demand_state (demand_checkpoint), whose
+    products[code]["plateau_start"] is kept current by replay_log; a
+    product's timeline is rebuilt only when that value or the order count
+    changes. clock is the injectable time source used whenever `now` is not
+    passed explicitly.
+    """
+
+    def __init__(self, demand_state, clock=datetime.now):
+        self.demand_state = demand_state
+        self.clock = clock
+        self._timelines = {}  # product_code -> (plateau_start as stored in demand_state, timeline)
+
+    def timeline(self, product_code, order_count):
+        pstate = self.demand_state["products"].get(product_code)
+        plateau_start = pstate["plateau_start"] if pstate else None
+        cached = self._timelines.get(product_code)
+        if cached is not None and cached[0] == plateau_start and cached[1]["order_count"] == order_count:
+            return cached[1]
+        plateau_start_date = datetime.fromisoformat(plateau_start) if plateau_start else None
+        timeline = build_margin_timeline(plateau_start_date, order_count)
+        self._timelines[product_code] = (plateau_start, timeline)
+        return timeline
+
+    def margin_at(self, product_code, order_count, now=None):
+        """Margin for a quote: a lookup in the product's precomputed timeline."""
+        return margin_from_timeline(self.timeline(product_code, order_count), now or self.clock())
+
+# --- 3. Cross-Check + Benchmark Against get_dynamic_margin_with_log ---
+def cross_check(timelines, event_log_file, product_codes, order_counts, times):
+    """
+    Compares timeline lookups with get_dynamic_margin_with_log (a scan of the
+    event log) at each injected time. Returns a list of (product_code,
+    order_count, time, timeline_value, log_value) mismatches.
+    """
+    mismatches = []
+    for product_code in product_codes:
+        for order_count in order_counts:
+            for now in times:
+                expected = get_dynamic_margin_with_log(product_code, order_count, event_log_file, now=now)
+                got = timelines.margin_at(product_code, order_count, now)
+                if abs(float(got) - float(expected)) > 1e-9:
+                    mismatches.append((product_code, order_count, now, got, expected))
+    return mismatches
+
+if __name__ == "__main__":
+    import sys
+    import time
+
+    event_log_file = sys.argv[1] if len(sys.argv) > 1 else "negotiation_events.jsonl"
+    product_codes = set()
+    if os.path.exists(event_log_file):
+        with open(event_log_file, "r") as f:
+            for line in f:
+                try:
+                    product_codes.add(json.loads(line)["product_code"])
+                except Exception:
+                    continue
+    product_codes = sorted(product_codes)
+
+    start = datetime(2025, 6, 1)
+    times = [start + timedelta(hours=6 * i) for i in range(4 * 120)]
+    order_counts = [0, 100, 750, 1500]
+    demand_state = new_demand_state()
+    replay_log(demand_state, event_log_file)
+    timelines = MarginTimelines(demand_state, clock=lambda: start)
+
+    mismatches = cross_check(timelines, event_log_file, product_codes, order_counts, times)
+    print(f"Cross-checked {len(product_codes)} products x {len(order_counts)} order counts x {len(times)} times:"
+          f" {len(mismatches)} mismatch(es)")
+    for m in mismatches[:10]:
+        print(f"  {m}")
+
+    for name, quote in (
+        ("get_dynamic_margin_with_log", lambda p, t: get_dynamic_margin_with_log(p, 750, event_log_file, now=t)),
+        ("MarginTimelines.margin_at", lambda p, t: timelines.margin_at(p, 750, t)),
+    ):
+        t0 = time.perf_counter()
+        for p in product_codes:
+            for t in times:
+                quote(p, t)
+        elapsed = time.perf_counter() - t0
+        n = max(len(product_codes) * len(times), 1)
+        print(f"{name}: {1e6 * elapsed / n:.1f} µs per quote")
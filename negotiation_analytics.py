@@ -0,0 +1,313 @@
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+# --- CONFIGURABLE SETTINGS ---
+ANALYTICS_FILE = "negotiation_analytics.json"
+REBUILD_CHUNK_SIZE = 5000
+CLASSIFICATIONS = ("no_negotiation", "fallback", "main")
+KEY_SEP = "|"
+
+# Rollups are a plain dict of daily buckets, keyed "firm|category|product_code":
+# {
+#     "days": {"2025-06-17": {"Mahesh Enterprise|Herbicide|ME-H001": bucket}},
+#     "event_offset": <bytes of the event log already ingested>,
+#     "sessions_recorded": <leading entries of the session log already recorded>,
+# }
+
+# --- 1. Buckets ---
+def new_rollups():
+    return {"days": {}, "event_offset": 0, "sessions_recorded": 0}
+
+# Bucket fields filled from the session log (the rest come from the event log)
+SESSION_FIELDS = ("sessions", "deals", "rounds_to_close", "discount_pct_sum", "discount_count", "bulk_upgrades")
+
+def _new_bucket():
+    return {
+        "sessions": 0,
+        "deals": 0,
+        "rounds_to_close": 0,
+        "discount_pct_sum": 0.0,
+        "discount_count": 0,
+        "bulk_upgrades": 0,
+        "classifications": {c: 0 for c in CLASSIFICATIONS},
+        "events": {},
+    }
+
+def _bucket(rollups, day, firm, category, product_code):
+    key = KEY_SEP.join((firm or "", category or "", product_code or ""))
+    day_buckets = rollups["days"].setdefault(day, {})
+    if key not in day_buckets:
+        day_buckets[key] = _new_bucket()
+    return day_buckets[key]
+
+def build_product_index(firms):
+    """Maps product_code -> (firm, category) from the products_firms.json structure."""
+    index = {}
+    for firm_name, firm in firms.items():
+        for category, products in firm.get("categories", {}).items():
+            for prod in products:
+                index[prod["product_code"]] = (firm_name, category)
+    return index
+
+# --- 2. Incremental Updates ---
+def _session_outcome(session):
+    """Returns (is_deal, final_price), accepting both the current and the older log layout."""
+    if session.get("final_status") == "deal":
+        return True, session.get("final_price")
+    if session.get("status") == "accepted":
+        return True, session.get("final_price", session.get("negotiated_price"))
+    return False, None
+
+def record_session(rollups, session, product_index=None):
+    """
+    Adds one finished session (an entry of negotiation_cli_log.json) to its
+    daily bucket. Older entries carry no firm/category; those are looked up
+    in product_index, the same way record_event attributes events.
+    """
+    day = (session.get("updated_at") or session.get("created_at") or "")[:10]
+    product_code = session.get("product_code")
+    firm, category = session.get("firm"), session.get("category")
+    if not firm or not category:
+        firm, category = (product_index or {}).get(product_code, (firm, category))
+    bucket = _bucket(rollups, day, firm, category, product_code)
+    bucket["sessions"] += 1
+
+    classification = session.get("classification", session.get("formula_used"))
+    if classification in bucket["classifications"]:
+        bucket["classifications"][classification] += 1
+
+    if session.get("bulk_upgrade"):
+        bucket["bulk_upgrades"] += 1
+
+    is_deal, final_price = _session_outcome(session)
+    if is_deal:
+        bucket["deals"] += 1
+        bucket["rounds_to_close"] += len(session.get("history") or [])
+        price = session.get("price")
+        if price and final_price is not None:
+            bucket["discount_pct_sum"] += 100.0 * (price - final_price) / price
+            bucket["discount_count"] += 1
+
+def catch_up_sessions(rollups, sessions, product_index=None):
+    """
+    Records the entries of the session log (a list, append-only) past the
+    rollups' sessions_recorded position: sessions finished since the last
+    call, including ones written before a crash kept them out of the saved
+    rollups. Position rather than session id, since resumed sessions can
+    finish after newer ones. Returns how many were recorded.
+    """
+    recorded = rollups.get("sessions_recorded", 0)
+    if len(sessions) < recorded:
+        # Session log was reset or rewritten: the session counts can't be trusted anymore.
+        for day_buckets in rollups["days"].values():
+            for bucket in day_buckets.values():
+                for field in SESSION_FIELDS:
+                    bucket[field] = 0
+                bucket["classifications"] = {c: 0 for c in CLASSIFICATIONS}
+        recorded = 0
+    for session in sessions[recorded:]:
+        record_session(rollups, session, product_index)
+    rollups["sessions_recorded"] = len(sessions)
+    return len(sessions) - recorded
+
+def record_event(rollups, entry, product_index=None):
+    """Counts one event-log entry by type in its product's daily bucket."""
+    product_code = entry.get("product_code")
+    day = (entry.get("timestamp") or "")[:10]
+    firm, category = (product_index or {}).get(product_code, ("", ""))
+    bucket = _bucket(rollups, day, firm, category, product_code)
+    event_type = entry.get("event", "unknown")
+    bucket["events"][event_type] = bucket["events"].get(event_type, 0) + 1
+
+def ingest_events(rollups, event_log_file, product_index=None):
+    """Records event-log lines appended since the last call. Returns how many were read."""
+    if not os.path.exists(event_log_file):
+        return 0
+    if os.path.getsize(event_log_file) < rollups.get("event_offset", 0):
+        # Log was truncated or replaced: the event counts can't be trusted anymore.
+        for day_buckets in rollups["days"].values():
+            for bucket in day_buckets.values():
+                bucket["events"] = {}
+        rollups["event_offset"] = 0
+    count = 0
+    with open(event_log_file, "rb") as f:
+        f.seek(rollups.get("event_offset", 0))
+        offset = rollups.get("event_offset", 0)
+        for raw in f:
+            if not raw.endswith(b"\n"):
+                break
+            offset += len(raw)
+            try:
+                record_event(rollups, json.loads(raw), product_index)
+            except Exception:
+                pass
+            count += 1
+    rollups["event_offset"] = offset
+    return count
+
+# --- 3. Merge + Parallel Rebuild From History ---
+def _add_bucket(dst, src):
+    for field in SESSION_FIELDS:
+        dst[field] += src[field]
+    for c, n in src["classifications"].items():
+        dst["classifications"][c] = dst["classifications"].get(c, 0) + n
+    for e, n in src["events"].items():
+        dst["events"][e] = dst["events"].get(e, 0) + n
+
+def merge_rollups(target, other):
+    for day, day_buckets in other["days"].items():
+        for key, src in day_buckets.items():
+            _add_bucket(target["days"].setdefault(day, {}).setdefault(key, _new_bucket()), src)
+    return target
+
+def _rollup_sessions_chunk(args):
+    sessions, product_index = args
+    rollups = new_rollups()
+    for session in sessions:
+        record_session(rollups, session, product_index)
+    return rollups
+
+def _rollup_events_chunk(args):
+    lines, product_index = args
+    rollups = new_rollups()
+    for line in lines:
+        try:
+            record_event(rollups, json.loads(line), product_index)
+        except Exception:
+            continue
+    return rollups
+
+def _chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+def rebuild_rollups(session_log_file, event_log_file=None, product_index=None,
+                    workers=None, chunk_size=REBUILD_CHUNK_SIZE):
+    """
+    Rebuilds all rollups from history, splitting sessions and event lines into
+    chunks that are aggregated on separate cores and merged.
+    """
+    sessions = []
+    if os.path.exists(session_log_file):
+        with open(session_log_file, "r") as f:
+            try:
+                data = json.load(f)
+            except json.decoder.JSONDecodeError:
+                data = []
+        if isinstance(data, list):
+            sessions = data
+
+    event_lines = []
+    event_offset = 0
+    if event_log_file and os.path.exists(event_log_file):
+        with open(event_log_file, "rb") as f:
+            for raw in f:
+                if not raw.endswith(b"\n"):
+                    break
+                event_offset += len(raw)
+                event_lines.append(raw)
+
+    session_chunks = [(chunk, product_index) for chunk in _chunks(sessions, chunk_size)]
+    event_chunks = [(chunk, product_index) for chunk in _chunks(event_lines, chunk_size)]
+    if workers == 1:
+        # In-process, e.g. when called at import time of a script that a
+        # spawned worker would re-import.
+        partials = [_rollup_sessions_chunk(chunk) for chunk in session_chunks]
+        partials += [_rollup_events_chunk(chunk) for chunk in event_chunks]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            partials = list(pool.map(_rollup_sessions_chunk, session_chunks))
+            partials += list(pool.map(_rollup_events_chunk, event_chunks))
+
+    rollups = new_rollups()
+    for partial in partials:
+        merge_rollups(rollups, partial)
+    rollups["event_offset"] = event_offset
+    rollups["sessions_recorded"] = len(sessions)
+    return rollups
+
+# --- 4. Persistence ---
+def save_rollups(rollups, analytics_file=ANALYTICS_FILE):
+    tmp_file = analytics_file + ".tmp"
+    with open(tmp_file, "w") as f:
+        json.dump(rollups, f)
+    os.replace(tmp_file, analytics_file)
+
+def load_rollups(analytics_file=ANALYTICS_FILE):
+    if not os.path.exists(analytics_file):
+        return None
+    try:
+        with open(analytics_file, "r") as f:
+            rollups = json.load(f)
+    except (OSError, json.decoder.JSONDecodeError):
+        return None
+    if not isinstance(rollups, dict) or "days" not in rollups or "sessions_recorded" not in rollups:
+        # Rollups saved before the session-log position was tracked can't be caught up safely
+        return None
+    return rollups
+
+# --- 5. Queries (daily rollups only, never raw logs) ---
+def _metrics(bucket):
+    sessions = bucket["sessions"]
+    deals = bucket["deals"]
+    classified = sum(bucket["classifications"].values())
+    return {
+        "sessions": sessions,
+        "deals": deals,
+        "conversion_rate": deals / sessions if sessions else None,
+        "avg_rounds_to_close": bucket["rounds_to_close"] / deals if deals else None,
+        "avg_discount_pct": (
+            bucket["discount_pct_sum"] / bucket["discount_count"] if bucket["discount_count"] else None
+        ),
+        "bulk_upgrade_rate": bucket["bulk_upgrades"] / sessions if sessions else None,
+        "classification_mix": {
+            c: (n / classified if classified else None) for c, n in bucket["classifications"].items()
+        },
+        "events": dict(bucket["events"]),
+    }
+
+def query_rollups(rollups, firm=None, category=None, product_code=None,
+                  start_day=None, end_day=None, group_by=None):
+    """
+    Sums the daily buckets matching the filters (days are inclusive
+    'YYYY-MM-DD' strings) and returns the metrics. With group_by set to
+    'firm', 'category', 'product_code' or 'day', returns {group: metrics}.
+    """
+    group_fields = ("firm", "category", "product_code")
+    totals = {}
+    for day, day_buckets in rollups["days"].items():
+        if (start_day and day < start_day) or (end_day and day > end_day):
+            continue
+        for key, bucket in day_buckets.items():
+            b_firm, b_category, b_product = key.split(KEY_SEP)
+            if (firm and b_firm != firm) or (category and b_category != category) \
+                    or (product_code and b_product != product_code):
+                continue
+            if group_by == "day":
+                group = day
+            elif group_by in group_fields:
+                group = (b_firm, b_category, b_product)[group_fields.index(group_by)]
+            else:
+                group = None
+            _add_bucket(totals.setdefault(group, _new_bucket()), bucket)
+    if group_by is None:
+        return _metrics(totals.get(None, _new_bucket()))
+    return {group: _metrics(bucket) for group, bucket in sorted(totals.items())}
+
+if __name__ == "__main__":
+    import sys
+
+    session_log_file = sys.argv[1] if len(sys.argv) > 1 else "negotiation_cli_log.json"
+    event_log_file = sys.argv[2] if len(sys.argv) > 2 else "negotiation_events.jsonl"
+    products_file = "products_firms.json"
+
+    product_index = None
+    if os.path.exists(products_file):
+        with open(products_file, "r") as f:
+            product_index = build_product_index(json.load(f))
+
+    rollups = rebuild_rollups(session_log_file, event_log_file, product_index)
+    save_rollups(rollups)
+    for firm_name, metrics in query_rollups(rollups, group_by="firm").items():
+        print(f"{firm_name or '(unknown)'}: {metrics}")
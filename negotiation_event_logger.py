@@ -1,6 +1,9 @@
 import json
+import os
 from datetime import datetime
 
+from event_log_index import append_index_entry
+
 LOG_FILE = "negotiation_events.jsonl"  # Use .jsonl extension for line-delimited JSON
 
 def log_event(event_type, data, log_mode="file", log_file=LOG_FILE, db_conn=None):
@@ -19,8 +22,13 @@ def log_event(event_type, data, log_mode="file", log_file=LOG_FILE, db_conn=None
     }
     entry.update(data)
     if log_mode == "file":
-        with open(log_file, "a") as f:
-            f.write(json.dumps(entry) + "\n")
+        raw = (json.dumps(entry) + "\n").encode("utf-8")
+        with open(log_file, "ab") as f:
+            f.seek(0, os.SEEK_END)
+            offset = f.tell()
+            f.write(raw)
+        # Keep the sidecar byte-offset index (negotiation_events.jsonl.idx) in step
+        append_index_entry(log_file, offset, raw)
     elif log_mode == "sql" and db_conn:
         # --- Future placeholder for SQL logging ---
         # You would insert the `entry` dictionary as a row in your SQL table here
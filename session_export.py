@@ -0,0 +1,409 @@
+import codecs
+import hashlib
+import json
+import os
+
+import numpy as np
+
+# --- CONFIGURABLE SETTINGS ---
+EXPORT_DIR = "session_export"
+MANIFEST_FILE = "manifest.json"
+READ_CHUNK_BYTES = 1 << 20
+MAX_PARTS = 32  # incremental exports merge their part files once there are more than this
+FINGERPRINT_BYTES = 64 * 1024  # bytes before the resume offset whose hash must still match
+
+# Typed columns of the two tables. Sessions and rounds join on session_id;
+# sessions sharing an id are treated as one session by the helpers below.
+SESSION_COLUMNS = {
+    "session_id": np.int64,
+    "user_id": np.int64,            # -1 when missing
+    "quantity": np.int64,
+    "price": np.float64,
+    "cost_price": np.float64,
+    "negotiation_min": np.float64,  # NaN when missing
+    "final_price": np.float64,      # NaN when no deal
+    "n_rounds": np.int32,
+    "is_deal": np.bool_,
+    "bulk_upgrade": np.bool_,
+    "created_at": "datetime64[s]",  # NaT when missing
+    "product_code": np.str_,
+    "firm": np.str_,
+    "category": np.str_,
+    "classification": np.str_,
+    "final_status": np.str_,
+}
+ROUND_COLUMNS = {
+    "session_id": np.int64,
+    "round": np.int32,
+    "user_offer": np.float64,
+    "bot_counter_offer": np.float64,  # NaN when the bot made no counter
+    "timestamp": "datetime64[s]",
+}
+
+# --- 1. Streaming Reader for negotiation_cli_log.json ---
+def iter_sessions(session_log_file, start_offset=0, chunk_bytes=READ_CHUNK_BYTES):
+    """
+    Yields (session, end_offset) for each element of the top-level JSON array
+    without loading the whole file. end_offset is the byte offset just past
+    the element, and can be passed back as start_offset to continue after it.
+    """
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder("utf-8")()
+    with open(session_log_file, "rb") as f:
+        f.seek(start_offset)
+        buf = ""
+        pos = 0
+        offset = start_offset  # byte offset of buf[pos]
+        eof = False
+        expect_open = start_offset == 0
+
+        def fill():
+            nonlocal buf, pos, eof
+            buf = buf[pos:]
+            pos = 0
+            data = f.read(chunk_bytes)
+            if not data:
+                eof = True
+            buf += utf8.decode(data, final=not data)
+
+        fill()
+        while True:
+            # Whitespace, '[' and ',' are single-byte, so they advance offset by one
+            while pos < len(buf) and buf[pos] in " \t\r\n":
+                pos += 1
+                offset += 1
+            if pos >= len(buf):
+                if eof:
+                    return
+                fill()
+                continue
+            ch = buf[pos]
+            if expect_open:
+                if ch != "[":
+                    raise ValueError(f"{session_log_file} is not a JSON array")
+                expect_open = False
+                pos += 1
+                offset += 1
+                continue
+            if ch == "]":
+                return
+            if ch == ",":
+                pos += 1
+                offset += 1
+                continue
+            try:
+                session, end = decoder.raw_decode(buf, pos)
+            except json.decoder.JSONDecodeError:
+                if eof:
+                    raise
+                fill()
+                continue
+            offset += len(buf[pos:end].encode("utf-8"))
+            pos = end
+            yield session, offset
+
+# --- 2. Flattening ---
+def _float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+def _int(value, default=-1):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return default
+
+def _datetime(value):
+    try:
+        return np.datetime64(str(value)[:19], "s")
+    except ValueError:
+        return np.datetime64("NaT", "s")
+
+def _flatten(session, session_cols, round_cols):
+    session_id = _int(session.get("id"))
+    history = session.get("history") or []
+    is_deal = session.get("final_status") == "deal" or session.get("status") == "accepted"
+    final_price = session.get("final_price", session.get("negotiated_price")) if is_deal else None
+
+    row = {
+        "session_id": session_id,
+        "user_id": _int(session.get("user_id")),
+        "quantity": _int(session.get("quantity"), 0),
+        "price": _float(session.get("price")),
+        "cost_price": _float(session.get("cost_price")),
+        "negotiation_min": _float(session.get("negotiation_min", session.get("min_negotiable_price"))),
+        "final_price": _float(final_price),
+        "n_rounds": len(history),
+        "is_deal": is_deal,
+        "bulk_upgrade": bool(session.get("bulk_upgrade")),
+        "created_at": _datetime(session.get("created_at")),
+        "product_code": session.get("product_code") or "",
+        "firm": session.get("firm") or "",
+        "category": session.get("category") or "",
+        "classification": session.get("classification") or session.get("formula_used") or "",
+        "final_status": session.get("final_status") or session.get("status") or "",
+    }
+    for name, value in row.items():
+        session_cols[name].append(value)
+
+    for i, item in enumerate(history, 1):
+        round_cols["session_id"].append(session_id)
+        # Older log entries number rounds as "stage"
+        round_cols["round"].append(_int(item.get("round", item.get("stage")), i))
+        round_cols["user_offer"].append(_float(item.get("user_offer")))
+        round_cols["bot_counter_offer"].append(_float(item.get("bot_counter_offer")))
+        round_cols["timestamp"].append(_datetime(item.get("timestamp")))
+
+def _to_arrays(cols, schema):
+    return {name: np.array(cols[name], dtype=schema[name]) for name in schema}
+
+# --- 3. Export (full or incremental) ---
+def _load_manifest(export_dir):
+    path = os.path.join(export_dir, MANIFEST_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path, "r") as f:
+        return json.load(f)
+
+def _save_manifest(export_dir, manifest):
+    path = os.path.join(export_dir, MANIFEST_FILE)
+    tmp_file = path + ".tmp"
+    with open(tmp_file, "w") as f:
+        json.dump(manifest, f, indent=4)
+    os.replace(tmp_file, path)
+
+def _prefix_fingerprint(session_log_file, offset):
+    """sha256 of the FINGERPRINT_BYTES before offset: the last exported element(s)."""
+    start = max(0, offset - FINGERPRINT_BYTES)
+    with open(session_log_file, "rb") as f:
+        f.seek(start)
+        return hashlib.sha256(f.read(offset - start)).hexdigest()
+
+def _resume_point_valid(session_log_file, manifest):
+    """
+    The bytes before the manifest's offset must be the ones exported last
+    time (same fingerprint), and the byte after it the ',' or ']' that
+    follows an array element.
+    """
+    offset = manifest["log_offset"]
+    if offset <= 0 or os.path.getsize(session_log_file) < offset:
+        return False
+    if manifest.get("log_fingerprint") != _prefix_fingerprint(session_log_file, offset):
+        return False
+    with open(session_log_file, "rb") as f:
+        f.seek(offset)
+        rest = f.read(64).lstrip()
+    return rest[:1] in (b",", b"]")
+
+def _clear_parts(export_dir):
+    for name in os.listdir(export_dir):
+        if (name.startswith("sessions_") or name.startswith("rounds_")) and name.endswith(".npz"):
+            os.remove(os.path.join(export_dir, name))
+
+def _part_path(export_dir, prefix, part):
+    return os.path.join(export_dir, f"{prefix}_{part:05d}.npz")
+
+def _part_range(manifest):
+    return range(manifest.get("first_part", 1), manifest["parts"] + 1)
+
+def _save_part(export_dir, prefix, part, arrays):
+    # Via a file object, so np.savez_compressed doesn't append its own ".npz"
+    tmp_file = _part_path(export_dir, prefix, part) + ".tmp"
+    with open(tmp_file, "wb") as f:
+        np.savez_compressed(f, **arrays)
+    os.replace(tmp_file, _part_path(export_dir, prefix, part))
+
+def export_sessions(session_log_file, export_dir=EXPORT_DIR, incremental=True, max_parts=MAX_PARTS):
+    """
+    Flattens sessions and their rounds into compressed columnar part files
+    (sessions_NNNNN.npz / rounds_NNNNN.npz). With incremental=True only
+    sessions appended since the last export are read, starting from the byte
+    offset recorded in the manifest; if the log no longer lines up with that
+    offset, or the bytes before it no longer match their recorded fingerprint
+    (log rewritten or truncated), everything is exported again. Once there
+    are more than max_parts part files they are compacted into one.
+    Returns the number of sessions exported.
+    """
+    os.makedirs(export_dir, exist_ok=True)
+    manifest = _load_manifest(export_dir) if incremental else None
+    if manifest is None or not _resume_point_valid(session_log_file, manifest):
+        _clear_parts(export_dir)
+        manifest = {"log_offset": 0, "log_fingerprint": None, "sessions": 0, "rounds": 0,
+                    "first_part": 1, "parts": 0}
+
+    session_cols = {name: [] for name in SESSION_COLUMNS}
+    round_cols = {name: [] for name in ROUND_COLUMNS}
+    end_offset = manifest["log_offset"]
+    count = 0
+    for session, end_offset in iter_sessions(session_log_file, manifest["log_offset"]):
+        _flatten(session, session_cols, round_cols)
+        count += 1
+    if count == 0:
+        return 0
+
+    part = manifest["parts"] + 1
+    _save_part(export_dir, "sessions", part, _to_arrays(session_cols, SESSION_COLUMNS))
+    _save_part(export_dir, "rounds", part, _to_arrays(round_cols, ROUND_COLUMNS))
+    manifest.update({
+        "log_offset": end_offset,
+        "log_fingerprint": _prefix_fingerprint(session_log_file, end_offset),
+        "sessions": manifest["sessions"] + count,
+        "rounds": manifest["rounds"] + len(round_cols["session_id"]),
+        "parts": part,
+    })
+    _save_manifest(export_dir, manifest)
+    if len(_part_range(manifest)) > max_parts:
+        compact_export(export_dir)
+    return count
+
+def _load_parts(export_dir, manifest):
+    tables = []
+    for prefix, schema in (("sessions", SESSION_COLUMNS), ("rounds", ROUND_COLUMNS)):
+        columns = {name: [] for name in schema}
+        for i in _part_range(manifest):
+            with np.load(_part_path(export_dir, prefix, i)) as part:
+                for name in schema:
+                    columns[name].append(part[name])
+        tables.append({
+            name: np.concatenate(arrays) if arrays else np.array([], dtype=schema[name])
+            for name, arrays in columns.items()
+        })
+    return tables[0], tables[1]
+
+def load_export(export_dir=EXPORT_DIR):
+    """Returns (sessions, rounds) as dicts of column arrays, concatenated across parts."""
+    return _load_parts(export_dir, _load_manifest(export_dir) or {"parts": 0})
+
+def compact_export(export_dir=EXPORT_DIR):
+    """
+    Merges all part files into a single new part. The manifest only switches
+    to the merged part once it is written, so a crash midway leaves the
+    export as it was. Returns the number of part files merged.
+    """
+    manifest = _load_manifest(export_dir)
+    if manifest is None or len(_part_range(manifest)) <= 1:
+        return 0
+    old_parts = _part_range(manifest)
+    sessions, rounds = _load_parts(export_dir, manifest)
+    part = manifest["parts"] + 1
+    _save_part(export_dir, "sessions", part, sessions)
+    _save_part(export_dir, "rounds", part, rounds)
+    manifest.update({"first_part": part, "parts": part})
+    _save_manifest(export_dir, manifest)
+    for i in old_parts:
+        for prefix in ("sessions", "rounds"):
+            os.remove(_part_path(export_dir, prefix, i))
+    return len(old_parts)
+
+# --- 4. Vectorized Trajectory Helpers ---
+def join_session_column(sessions, rounds, column):
+    """Per-round value of a session column, matched on session_id."""
+    order = np.argsort(sessions["session_id"], kind="stable")
+    sorted_ids = sessions["session_id"][order]
+    idx = np.searchsorted(sorted_ids, rounds["session_id"])
+    idx = np.clip(idx, 0, len(sorted_ids) - 1)
+    found = sorted_ids[idx] == rounds["session_id"] if len(sorted_ids) else np.zeros(len(idx), bool)
+    values = sessions[column][order][idx] if len(sorted_ids) else np.empty(len(idx), sessions[column].dtype)
+    if values.dtype.kind == "f":
+        values = np.where(found, values, np.nan)
+    return values
+
+def gap_to_min(sessions, rounds):
+    """user_offer - negotiation_min for every round (negative = still below the floor)."""
+    return rounds["user_offer"] - join_session_column(sessions, rounds, "negotiation_min")
+
+def counter_gap(rounds):
+    """bot_counter_offer - user_offer for every round (NaN when there was no counter)."""
+    return rounds["bot_counter_offer"] - rounds["user_offer"]
+
+def _session_order(rounds):
+    """
+    Stable sort of the rounds by session_id: each session's rounds end up in
+    one contiguous run, still in the order they were stored (round order),
+    even when a session id shows up again in a later part.
+    """
+    return np.argsort(rounds["session_id"], kind="stable")
+
+def _session_starts(ids):
+    """Indices where a new run of equal ids begins; ids must already be grouped."""
+    if len(ids) == 0:
+        return np.array([], dtype=np.int64)
+    return np.flatnonzero(np.concatenate(([True], ids[1:] != ids[:-1])))
+
+def _first_rounds(rounds):
+    """Mask (aligned with rounds) of each session's first round."""
+    order = _session_order(rounds)
+    first = np.zeros(len(order), dtype=bool)
+    first[order[_session_starts(rounds["session_id"][order])]] = True
+    return first
+
+def offer_concessions(rounds):
+    """How much the buyer raised their offer versus their previous round (NaN on the first round)."""
+    order = _session_order(rounds)
+    offers = rounds["user_offer"][order]
+    step = np.empty_like(offers)
+    if len(offers):
+        step[0] = np.nan
+        step[1:] = offers[1:] - offers[:-1]
+        step[_session_starts(rounds["session_id"][order])] = np.nan
+    result = np.empty_like(step)
+    result[order] = step
+    return result
+
+def rounds_to_converge(sessions, rounds, tolerance=0.0):
+    """
+    Per session (aligned with sessions["session_id"]): the 1-based position of
+    the first round whose offer reached negotiation_min - tolerance, or 0 if
+    the buyer never got there.
+    """
+    order = _session_order(rounds)
+    reached = (gap_to_min(sessions, rounds) >= -tolerance)[order]
+    ids = rounds["session_id"][order]
+    starts = _session_starts(ids)
+    result = np.zeros(len(sessions["session_id"]), dtype=np.int32)
+    if len(starts) == 0:
+        return result
+    lengths = np.diff(np.append(starts, len(reached)))
+    position = np.arange(len(reached)) - np.repeat(starts, lengths) + 1
+    big = np.iinfo(np.int32).max
+    first = np.minimum.reduceat(np.where(reached, position, big), starts)
+    first = np.where(first == big, 0, first)
+    run_ids = ids[starts]  # sorted and unique
+    idx = np.searchsorted(run_ids, sessions["session_id"])
+    idx = np.clip(idx, 0, len(run_ids) - 1)
+    matched = run_ids[idx] == sessions["session_id"]
+    result[matched] = first[idx][matched]
+    return result
+
+def trajectory_summary(sessions, rounds):
+    converge = rounds_to_converge(sessions, rounds)
+    concessions = offer_concessions(rounds)
+    price = join_session_column(sessions, rounds, "price")
+    first_round = _first_rounds(rounds)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        opening_discount = 100 * (price - rounds["user_offer"]) / price
+    return {
+        "sessions": int(len(sessions["session_id"])),
+        "rounds": int(len(rounds["session_id"])),
+        "deal_rate": float(np.mean(sessions["is_deal"])) if len(sessions["is_deal"]) else None,
+        "avg_rounds": float(np.mean(sessions["n_rounds"])) if len(sessions["n_rounds"]) else None,
+        "converged_share": float(np.mean(converge > 0)) if len(converge) else None,
+        "avg_rounds_to_converge": float(np.mean(converge[converge > 0])) if np.any(converge > 0) else None,
+        "avg_opening_discount_pct": (
+            float(np.nanmean(opening_discount[first_round])) if np.any(first_round) else None
+        ),
+        "avg_concession": float(np.nanmean(concessions)) if np.any(~np.isnan(concessions)) else None,
+    }
+
+if __name__ == "__main__":
+    import sys
+
+    session_log_file = sys.argv[1] if len(sys.argv) > 1 else "negotiation_cli_log.json"
+    export_dir = sys.argv[2] if len(sys.argv) > 2 else EXPORT_DIR
+
+    exported = export_sessions(session_log_file, export_dir)
+    print(f"✅ Exported {exported} new session(s) to {export_dir}/")
+    sessions, rounds = load_export(export_dir)
+    print(trajectory_summary(sessions, rounds))
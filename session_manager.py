@@ -0,0 +1,263 @@
+import json
+import os
+import sys
+import time
+from collections import OrderedDict
+
+from file_lock import FileLock
+
+# --- CONFIGURABLE SETTINGS ---
+SESSION_CHECKPOINT_DIR = "session_checkpoints"
+MAX_ACTIVE_SESSIONS = 1000
+SESSION_IDLE_TIMEOUT = 15 * 60  # seconds
+METRIC_WINDOW = 1000  # resume latencies kept for percentiles
+
+class SessionClaimed(Exception):
+    """The session was taken over by another process after sitting idle."""
+
+def _deep_sizeof(obj, seen=None):
+    """Approximate in-memory size of a JSON-like object, in bytes."""
+    seen = seen if seen is not None else set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(_deep_sizeof(k, seen) + _deep_sizeof(v, seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple)):
+        size += sum(_deep_sizeof(v, seen) for v in obj)
+    return size
+
+class SessionManager:
+    """
+    Keeps the working state of in-progress negotiations (stage, last_ctr,
+    offer history, qty after bulk upgrade, min_negotiation, ...) in a bounded
+    LRU working set.
+
+    Every put() also writes a compact on-disk checkpoint, so a session
+    survives the process dying mid-negotiation. Sessions idle for longer than
+    idle_timeout, or pushed out by max_active, are evicted from memory only;
+    get() loads them back from their checkpoint transparently.
+
+    The checkpoint directory is shared by every CLI process, so each session
+    has one owner: reserve() a new session id, or claim() an unfinished
+    session, before put(). The owner holds an OS lock on session_<id>.lock
+    (dropped when the process dies) and its token is kept in
+    session_<id>.owner; the checkpoint's mtime is its heartbeat. Another
+    process can claim the session once the owner is dead or has been idle
+    past idle_timeout, after which the old owner's put() raises
+    SessionClaimed.
+    """
+
+    def __init__(self, checkpoint_dir=SESSION_CHECKPOINT_DIR, max_active=MAX_ACTIVE_SESSIONS,
+                 idle_timeout=SESSION_IDLE_TIMEOUT, clock=time.monotonic):
+        self.checkpoint_dir = checkpoint_dir
+        self.max_active = max_active
+        self.idle_timeout = idle_timeout
+        self.clock = clock
+        self._active = OrderedDict()  # session_id -> (state, last_seen)
+        self._evictions = 0
+        self._resume_latencies = []
+        self._owned = {}  # session_id -> owner FileLock (None when taken over from an idle owner)
+        self.owner = f"{os.getpid()}:{id(self)}"
+        os.makedirs(checkpoint_dir, exist_ok=True)
+
+    # --- Checkpoint files ---
+    def _path(self, session_id):
+        return os.path.join(self.checkpoint_dir, f"session_{session_id}.json")
+
+    def _lock_path(self, session_id):
+        return os.path.join(self.checkpoint_dir, f"session_{session_id}.lock")
+
+    def _owner_path(self, session_id):
+        return os.path.join(self.checkpoint_dir, f"session_{session_id}.owner")
+
+    def _claims(self):
+        # Serializes reserving, claiming and handing back sessions across processes
+        return FileLock(os.path.join(self.checkpoint_dir, "claims.lock"))
+
+    def _read_checkpoint(self, session_id):
+        started = time.perf_counter()
+        try:
+            with open(self._path(session_id), "r") as f:
+                state = json.load(f)
+        except (OSError, json.decoder.JSONDecodeError):
+            return None
+        self._resume_latencies.append(time.perf_counter() - started)
+        del self._resume_latencies[:-METRIC_WINDOW]
+        return state
+
+    def _write_checkpoint(self, session_id, state):
+        path = self._path(session_id)
+        tmp_file = path + ".tmp"
+        with open(tmp_file, "w") as f:
+            json.dump(state, f, separators=(",", ":"))
+        os.replace(tmp_file, path)
+
+    # --- Ownership (call inside _claims()) ---
+    def _own(self, session_id, lock):
+        self._owned[session_id] = lock
+        with open(self._owner_path(session_id), "w") as f:
+            f.write(self.owner)
+
+    def _is_owner(self, session_id):
+        if session_id not in self._owned:
+            return False
+        try:
+            with open(self._owner_path(session_id), "r") as f:
+                return f.read() == self.owner
+        except OSError:
+            return False
+
+    def _claimable(self, session_id):
+        """Returns (claimable, owner lock taken for it). Owner dead, or idle past idle_timeout."""
+        lock = FileLock(self._lock_path(session_id))
+        if lock.acquire(blocking=False):
+            return True, lock
+        try:
+            # Checkpoint mtime is the owner's heartbeat; wall-clock since it is compared across processes
+            idle = time.time() - os.path.getmtime(self._path(session_id)) >= self.idle_timeout
+        except OSError:
+            idle = False
+        return idle, None
+
+    def reserve(self, first_id):
+        """
+        Takes ownership of the first session id from first_id on that has no
+        checkpoint and isn't reserved by another process, and returns it.
+        """
+        with self._claims():
+            session_id = first_id
+            while True:
+                if not os.path.exists(self._path(session_id)):
+                    lock = FileLock(self._lock_path(session_id))
+                    if lock.acquire(blocking=False):
+                        self._own(session_id, lock)
+                        return session_id
+                session_id += 1
+
+    def claim(self, session_id):
+        """
+        Takes ownership of an unfinished session and returns its state, or
+        None if it is unknown or still owned by a live, active process.
+        """
+        with self._claims():
+            if session_id in self._owned or not os.path.exists(self._path(session_id)):
+                return None
+            claimable, lock = self._claimable(session_id)
+            if not claimable:
+                return None
+            state = self._read_checkpoint(session_id)
+            if state is None:
+                if lock is not None:
+                    lock.release()
+                return None
+            # Taking over from an idle but live owner leaves its OS lock with it
+            self._own(session_id, lock)
+        self._active[session_id] = (state, self.clock())
+        self._active.move_to_end(session_id)
+        self.evict_idle()
+        return state
+
+    # --- Working set ---
+    def put(self, session_id, state):
+        """
+        Stores the latest state of an owned session and checkpoints it.
+        Raises SessionClaimed if another process has taken it over.
+        """
+        with self._claims():
+            if not self._is_owner(session_id):
+                raise SessionClaimed(session_id)
+            self._write_checkpoint(session_id, state)
+        self._active[session_id] = (state, self.clock())
+        self._active.move_to_end(session_id)
+        self.evict_idle()
+
+    def get(self, session_id):
+        """Returns the state of a session, resuming it from disk if evicted. None if unknown."""
+        if session_id in self._active:
+            state, _ = self._active[session_id]
+            self._active[session_id] = (state, self.clock())
+            self._active.move_to_end(session_id)
+            return state
+        if not os.path.exists(self._path(session_id)):
+            return None
+        state = self._read_checkpoint(session_id)
+        if state is None:
+            return None
+        self._active[session_id] = (state, self.clock())
+        self.evict_idle()
+        return state
+
+    def finish(self, session_id):
+        """
+        Drops a completed (or abandoned, reserved) session from memory and
+        gives up ownership, removing its checkpoint if this process still owns it.
+        """
+        self._active.pop(session_id, None)
+        with self._claims():
+            if self._is_owner(session_id):
+                for path in (self._path(session_id), self._owner_path(session_id)):
+                    if os.path.exists(path):
+                        os.remove(path)
+            lock = self._owned.pop(session_id, None)
+            if lock is not None:
+                lock.release()
+                try:
+                    os.remove(self._lock_path(session_id))
+                except OSError:
+                    pass  # Still open elsewhere (Windows); it's reused as is
+
+    def evict_idle(self):
+        """Evicts sessions idle past the timeout, then least recently used ones over capacity."""
+        now = self.clock()
+        while self._active:
+            session_id, (_, last_seen) = next(iter(self._active.items()))
+            if now - last_seen < self.idle_timeout and len(self._active) <= self.max_active:
+                break
+            # Already checkpointed on put(), so eviction is just dropping it.
+            del self._active[session_id]
+            self._evictions += 1
+
+    def pending_sessions(self):
+        """Ids of unfinished sessions that can be claimed: owner dead, or idle past idle_timeout."""
+        ids = []
+        with self._claims():
+            for name in os.listdir(self.checkpoint_dir):
+                if not (name.startswith("session_") and name.endswith(".json")):
+                    continue
+                try:
+                    session_id = int(name[len("session_"):-len(".json")])
+                except ValueError:
+                    continue
+                if session_id in self._owned:
+                    continue
+                claimable, lock = self._claimable(session_id)
+                if lock is not None:
+                    lock.release()
+                if claimable:
+                    ids.append(session_id)
+        return sorted(ids)
+
+    # --- Metrics ---
+    def metrics(self):
+        sizes = [_deep_sizeof(state) for state, _ in self._active.values()]
+        latencies = sorted(self._resume_latencies)
+        return {
+            "active_sessions": len(self._active),
+            "evictions": self._evictions,
+            "resumes": len(latencies),
+            "avg_bytes_per_session": sum(sizes) / len(sizes) if sizes else 0,
+            "max_bytes_per_session": max(sizes, default=0),
+            "avg_resume_ms": 1000 * sum(latencies) / len(latencies) if latencies else None,
+            "p95_resume_ms": 1000 * latencies[int(0.95 * (len(latencies) - 1))] if latencies else None,
+        }
+
+if __name__ == "__main__":
+    checkpoint_dir = sys.argv[1] if len(sys.argv) > 1 else SESSION_CHECKPOINT_DIR
+    manager = SessionManager(checkpoint_dir)
+    pending = manager.pending_sessions()
+    print(f"Unfinished sessions: {pending}")
+    for session_id in pending:
+        manager.get(session_id)
+    print(manager.metrics())